@@ -0,0 +1,146 @@
+"""Command line interface to the WEPL calculator, for batch runs without a display.
+
+    The settings are read from config.cfg (as saved by the GUI), and can be overridden here. Example:
+
+        python batch.py --structures GTV "CTV 1" --structure-file RS.dcm --output output
+"""
+
+import argparse, os, sys
+
+from engine import WEPLEngine, BatchOptions, ConsoleProgress, Variable, CONFIG_FILE
+from results import isParquetAvailable
+from profiling import stageProfile
+from dicomindex import HeaderIndex
+
+def findStructureFile(folder, numberOfThreads=8):
+    """The single RTSTRUCT file in and below folder, recognized by its Modality (None if there is not exactly one)."""
+
+    headerIndex = HeaderIndex(folder)
+    headerIndex.discoverFiles(numberOfThreads)
+    headerIndex.save()
+    _, fRS = headerIndex.getSeriesFiles(folder)
+    if len(fRS) != 1:
+        return None
+    return fRS[0]
+
+def parseArguments(argv=None):
+    parser = argparse.ArgumentParser(description="Calculate WEPL distributions of structures without the GUI.")
+    parser.add_argument("--config", default=CONFIG_FILE, help="Config file with the settings (default: %(default)s)")
+    parser.add_argument("--data-folder", help="Root directory for the image series (default: dataFolderDS)")
+    parser.add_argument("--structure-file", help="RS file to use for all series (default: the single RTSTRUCT file in and below dataFolderRS)")
+    parser.add_argument("--structures", nargs="+", required=True, help="Names of the structures to analyse")
+    parser.add_argument("--structure-number", choices=["first", "last", "all"], default="first",
+                        help="Structure to choose if multiple contours are found in a slice (default: %(default)s)")
+    parser.add_argument("--series", nargs="+", help="Only use these series, as \"SeriesDescription (StudyDate)\" (default: all)")
+    parser.add_argument("--rotations", nargs="+", type=float, help="Beam rotations in degrees (default: from config)")
+    parser.add_argument("--processes", type=int, help="Number of worker processes (default: numberOfProcesses)")
+    parser.add_argument("--read-threads", type=int, help="Number of threads reading the DICOM headers (default: numberOfReadThreads)")
+    parser.add_argument("--volume-cache", help="Folder for memory mapped HU volumes of the series (default: volumeCacheFolder)")
+    parser.add_argument("--checkpoint", help="Folder where each result is saved when calculated, to continue a stopped run (default: checkpointFolder)")
+    parser.add_argument("--result-cache", help="Folder of WEPL results to reuse, per image, contour and rotation (default: resultCacheFolder)")
+    parser.add_argument("--no-shared-memory", action="store_true",
+                        help="Let each worker process read the DICOM files, instead of sharing the volumes in memory")
+    parser.add_argument("--volume", action="store_true",
+                        help="Rotate the slices of each series together as one volume (in a single process)")
+    parser.add_argument("--method", choices=["rotate", "raytrace"],
+                        help="Rotate the images and sum the RSP, or ray trace through the unrotated images (default: weplMethod)")
+    parser.add_argument("--calibration", help="HU-RSP calibration curve file, see calibrations/ (default: calibrationFile, or Schneider)")
+    parser.add_argument("--compact", action="store_true",
+                        help="Keep the HU images as int16 and the RSP and WEPL images as float32 (see README for the precision)")
+    parser.add_argument("--histograms", action="store_true",
+                        help="Save WEPL histograms per 4D phase, structure and rotation instead of one row per pixel")
+    parser.add_argument("--parquet", action="store_true",
+                        help="Save the WEPL table as a Parquet dataset partitioned per 4D phase and rotation (needs pyarrow)")
+    parser.add_argument("--profile", help="Save the time per stage, counters and peak memory of the run as JSON to this file")
+    parser.add_argument("--output", default="output", help="Output folder (default: %(default)s)")
+    parser.add_argument("--quiet", action="store_true", help="Do not print the progress")
+    return parser.parse_args(argv)
+
+def main(argv=None):
+    args = parseArguments(argv)
+
+    if args.parquet and not isParquetAvailable():
+        print("Parquet output needs pyarrow (pip install pyarrow).")
+        return 1
+
+    options = BatchOptions()
+    options.loadOptions(args.config)
+    options.structureNumberVar.set({"first" : 0, "last" : -1, "all" : 1}[args.structure_number])
+
+    if args.data_folder:
+        options.dataFolderDS.set(args.data_folder)
+    if args.processes:
+        options.numberOfProcesses.set(args.processes)
+    if args.read_threads:
+        options.numberOfReadThreads.set(args.read_threads)
+    if args.volume_cache:
+        options.volumeCacheFolder.set(args.volume_cache)
+    if args.checkpoint:
+        options.checkpointFolder.set(args.checkpoint)
+    if args.result_cache:
+        options.resultCacheFolder.set(args.result_cache)
+    if args.calibration:
+        options.calibrationFile.set(args.calibration)
+    if args.compact:
+        options.compactPrecision.set(1)
+    if args.no_shared_memory:
+        options.sharedMemory.set(0)
+    if args.volume:
+        options.volumeMode.set(1)
+    if args.method:
+        options.weplMethod.set(args.method)
+    if args.rotations:
+        options.rotationEntry.set("list")
+        options.rotationList.set(" ".join(str(k) for k in args.rotations))
+
+    progress = not args.quiet and ConsoleProgress() or None
+    engine = WEPLEngine(options, progress)
+
+    if not options.useStructuresFromFolderTree.get():
+        structureFile = args.structure_file or findStructureFile(options.dataFolderRS.get(), int(options.numberOfReadThreads.get() or 1))
+        if not structureFile:
+            print(f"Could not find a single RTSTRUCT file in {options.dataFolderRS.get()}, use --structure-file.")
+            return 1
+        engine.loadStructureFile(structureFile)
+
+    print(f"Loading image series from {options.dataFolderDS.get()}")
+    engine.loadFolder(options.dataFolderDS.get())
+
+    for structureName in args.structures:
+        if engine.structureNames and not structureName in engine.structureNames:
+            print(f"Structure {structureName} not found. Available structures: {', '.join(engine.structureNames)}")
+            return 1
+        options.structureVariable[structureName] = Variable(1)
+
+    for name in engine.getSeriesNames():
+        options.seriesVariable[name] = Variable(int(not args.series or name in args.series))
+
+    if args.histograms:
+        options.histogramMode.set(1)
+
+    if options.histogramMode.get():
+        histograms, thisDate = engine.makeHistograms()
+        if not histograms:
+            print("No structure pixels found, nothing to save.")
+            return 1
+        fileNames = engine.writeHistogramResults(histograms, thisDate, args.output)
+
+    else:
+        dfSum, thisDate = engine.makeDataFrame()
+        if dfSum.empty:
+            print("No structure pixels found, nothing to save.")
+            return 1
+        fileNames = engine.writeResults(dfSum, thisDate, args.output, args.parquet)
+
+    for fileName in fileNames:
+        print(f"Saved {fileName}")
+
+    if not args.quiet:
+        print(stageProfile.getSummary())
+    if args.profile:
+        print(f"Saved {stageProfile.writeJSON(args.profile)}")
+
+    return 0
+
+if __name__ == "__main__":
+    sys.exit(main())
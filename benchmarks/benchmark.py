@@ -0,0 +1,239 @@
+"""Benchmark of the WEPL calculation on a synthetic 4D CT phantom (see phantom.py).
+
+    Times each stage of the calculation on every slice, series and rotation, and full runs of
+    makeDataFrame in several modes, and saves the timings with the machine and phantom parameters
+    as JSON, e.g. to compare two versions with --compare:
+
+        python benchmarks/benchmark.py --matrix 512 --slices 40 --phases 4 --output before.json
+        python benchmarks/benchmark.py --matrix 512 --slices 40 --phases 4 --output after.json --compare before.json
+"""
+
+import numpy as np
+import os, sys, json, time, platform, argparse, tempfile, subprocess, shutil
+
+sys.path.insert(0, os.path.dirname(os.path.dirname(os.path.abspath(__file__))))
+
+from engine import WEPLEngine, BatchOptions, Variable, getContourWEPL
+from classes import rasterizePolygon
+from results import ResultTable
+from cache import maskCache, sliceCache
+from dicomindex import HeaderIndex, INDEX_FILE
+from phantom import makePhantom
+
+BENCHMARK_VERSION = 1
+
+# Modes of the full runs: name, options, only with more than one process
+RUN_MODES = [ ("serial", {}, False),
+              ("volume", {'volumeMode' : 1}, False),
+              ("compact", {'compactPrecision' : 1}, False),
+              ("raytrace", {'weplMethod' : "raytrace"}, False),
+              ("processes", {}, True),
+              ("processes, no shared memory", {'sharedMemory' : 0}, True) ]
+
+class StageTimer:
+    """Wall-clock time and number of calls per stage."""
+
+    def __init__(self):
+        self.seconds = dict()
+        self.calls = dict()
+
+    def time(self, stage, function, *args):
+        start = time.perf_counter()
+        result = function(*args)
+        self.seconds[stage] = self.seconds.get(stage, 0) + time.perf_counter() - start
+        self.calls[stage] = self.calls.get(stage, 0) + 1
+        return result
+
+def clearCaches():
+    for cache in (maskCache, sliceCache):
+        cache.clear()
+
+def makeOptions(dataFolder, rotations, numberOfProcesses):
+    options = BatchOptions()
+    options.registrationVector.set("0 0 0")
+    options.rotationEntry.set("list")
+    options.rotationList.set(" ".join(str(k) for k in rotations))
+    options.dataFolderDS.set(dataFolder)
+    options.structureNumberVar.set(1)
+    options.numberOfProcesses.set(numberOfProcesses)
+    return options
+
+def makeEngine(options, structureFile):
+    engine = WEPLEngine(options)
+    engine.loadStructureFile(structureFile)
+    engine.loadFolder(options.dataFolderDS.get())
+
+    for structureName in engine.structureNames:
+        options.structureVariable[structureName] = Variable(1)
+    for name in engine.getSeriesNames():
+        options.seriesVariable[name] = Variable(1)
+
+    return engine
+
+def timeStages(options, structureFile):
+    """Time each stage of the per-slice calculation once, from cold caches. Returns { stage : (seconds, calls) }."""
+
+    timer = StageTimer()
+    clearCaches()
+
+    dataFolder = options.dataFolderDS.get()
+    for indexFile in [ HeaderIndex(dataFolder).getIndexFileName(), os.path.join(dataFolder, INDEX_FILE) ]:
+        if os.path.exists(indexFile):
+            os.remove(indexFile)
+
+    engine = WEPLEngine(options)
+    timer.time("loadStructureFile", engine.loadStructureFile, structureFile)
+    timer.time("loadImages (no header index)", engine.loadFolder, options.dataFolderDS.get())
+    timer.time("loadImages (header index)", WEPLEngine(options).loadFolder, options.dataFolderDS.get())
+
+    for structureName in engine.structureNames:
+        options.structureVariable[structureName] = Variable(1)
+    for name in engine.getSeriesNames():
+        options.seriesVariable[name] = Variable(1)
+
+    engine.makeReducedImageCollection()
+    timer.time("loadStructures", engine.loadCheckedStructures)
+
+    results = ResultTable()
+    rotations = engine.getRotationList()
+    for icIdx in engine.reducedImageCollection:
+        s = engine.imageCollection[icIdx]
+        for zpos in engine.getSlicePositions(s):
+            timer.time("readSlice", s.loadImageFromPosZ, zpos)
+
+            for rot in rotations:
+                s.resetImage()
+                timer.time("rotateImage (full image)", s.rotateImage, rot)
+
+                s.resetImage()
+                timer.time("rotateReducedImage", s.rotateReducedImage, rot, engine.imagePad)
+                timer.time("convertImageToRSP", s.convertImageToRSP)
+                wepl = timer.time("convertImageToWEPL", s.convertImageToWEPL)
+
+                X, Y = timer.time("getStructuresInImageCoordinates", s.getStructuresInImageCoordinates)
+                for contourX, contourY in zip(X, Y):
+                    timer.time("rasterizePolygon", rasterizePolygon, contourX, contourY, np.shape(s.image))
+
+                weplList = getContourWEPL(s, wepl)
+                for idx, weplImageBinned in enumerate(weplList):
+                    timer.time("aggregation", results.add, s.amplitude, idx, rot, weplImageBinned)
+
+    dfSum = timer.time("aggregation", results.toDataFrame)
+    timer.time("aggregation", lambda: dfSum.groupby(['4D phase', 'rotation'], observed=True)['WEPL'].quantile([0.25, 0.5, 0.75]))
+
+    return { stage : (timer.seconds[stage], timer.calls[stage]) for stage in timer.seconds }
+
+def timeRuns(options, structureFile, repeat, numberOfProcesses):
+    """Time makeDataFrame in each of the RUN_MODES, from cold caches. Returns { mode : timings }."""
+
+    runs = dict()
+    for mode, modeOptions, parallel in RUN_MODES:
+        if parallel and numberOfProcesses <= 1:
+            continue
+
+        seconds = list()
+        for k in range(repeat):
+            clearCaches()
+            thisOptions = makeOptions(options.dataFolderDS.get(), options.rotationList.get().split(),
+                                      parallel and numberOfProcesses or 1)
+            for name, value in modeOptions.items():
+                thisOptions.vars[name].set(value)
+
+            engine = makeEngine(thisOptions, structureFile)
+            start = time.perf_counter()
+            dfSum, thisDate = engine.makeDataFrame()
+            seconds.append(time.perf_counter() - start)
+
+        runs[mode] = { 'seconds' : seconds, 'min' : min(seconds), 'median' : float(np.median(seconds)), 'rows' : len(dfSum) }
+
+    return runs
+
+def getGitCommit():
+    try:
+        return subprocess.run(["git", "rev-parse", "--short", "HEAD"], cwd=os.path.dirname(os.path.abspath(__file__)),
+                              capture_output=True, text=True, check=True).stdout.strip()
+    except (OSError, subprocess.CalledProcessError):
+        return None
+
+def getMachine():
+    import scipy, pandas, pydicom
+    return { 'platform' : platform.platform(), 'processor' : platform.processor(), 'cpus' : os.cpu_count(),
+             'python' : platform.python_version(), 'numpy' : np.__version__, 'scipy' : scipy.__version__,
+             'pandas' : pandas.__version__, 'pydicom' : pydicom.__version__ }
+
+def printTable(report, other=None):
+    """Print the stages and runs, with the ratio to another report if given."""
+
+    rows = [ (f"stage {stage}", values['seconds'], values['calls']) for stage, values in report['stages'].items() ]
+    rows += [ (f"run {mode}", values['min'], len(values['seconds'])) for mode, values in report['runs'].items() ]
+
+    otherSeconds = dict()
+    if other:
+        otherSeconds.update({ f"stage {k}" : v['seconds'] for k, v in other['stages'].items() })
+        otherSeconds.update({ f"run {k}" : v['min'] for k, v in other['runs'].items() })
+
+    print(f"{'':42s} {'seconds':>10s} {'calls':>7s}" + (other and f" {'ratio':>7s}" or ""))
+    for name, seconds, calls in rows:
+        line = f"{name:42s} {seconds:10.4f} {calls:7d}"
+        if otherSeconds.get(name):
+            line += f" {seconds / otherSeconds[name]:7.2f}"
+        print(line)
+
+def parseArguments(argv=None):
+    parser = argparse.ArgumentParser(description="Benchmark the WEPL calculation on a synthetic 4D CT phantom.")
+    parser.add_argument("--matrix", type=int, default=256, help="Rows and columns of the images (default: %(default)s)")
+    parser.add_argument("--slices", type=int, default=20, help="Number of slices per phase (default: %(default)s)")
+    parser.add_argument("--phases", type=int, default=2, help="Number of 4D phases (default: %(default)s)")
+    parser.add_argument("--rotations", nargs="+", type=float, default=[0, 45, 90, 145], help="Beam rotations (default: %(default)s)")
+    parser.add_argument("--processes", type=int, default=2, help="Number of processes of the parallel runs, 1 to skip them (default: %(default)s)")
+    parser.add_argument("--repeat", type=int, default=3, help="Number of repeats of the full runs (default: %(default)s)")
+    parser.add_argument("--phantom", help="Folder of the phantom, made if it does not exist (default: a temporary folder)")
+    parser.add_argument("--output", default="benchmark.json", help="JSON file of the results (default: %(default)s)")
+    parser.add_argument("--compare", help="JSON file of an earlier benchmark, to print the ratios of the timings")
+    return parser.parse_args(argv)
+
+def main(argv=None):
+    args = parseArguments(argv)
+
+    phantomFolder = args.phantom or tempfile.mkdtemp(prefix="weplphantom_")
+    geometryFile = os.path.join(phantomFolder, "phantom.json")
+    if os.path.exists(geometryFile):
+        with open(geometryFile, "r") as geometry:
+            structureFile = os.path.join(phantomFolder, json.load(geometry)["structureFile"])
+    else:
+        print(f"Making a {args.phases} x {args.slices} x {args.matrix}x{args.matrix} phantom in {phantomFolder}")
+        structureFile = makePhantom(phantomFolder, args.matrix, args.slices, args.phases)
+
+    with open(geometryFile, "r") as geometry:
+        phantom = json.load(geometry)
+
+    try:
+        options = makeOptions(os.path.join(phantomFolder, "data"), args.rotations, 1)
+        stages = timeStages(options, structureFile)
+        runs = timeRuns(options, structureFile, args.repeat, args.processes)
+    finally:
+        if not args.phantom:
+            shutil.rmtree(phantomFolder)
+
+    report = { 'version' : BENCHMARK_VERSION, 'time' : time.strftime("%Y-%m-%dT%H:%M:%S"), 'commit' : getGitCommit(),
+               'machine' : getMachine(), 'phantom' : phantom,
+               'parameters' : { 'rotations' : args.rotations, 'processes' : args.processes, 'repeat' : args.repeat },
+               'stages' : { stage : { 'seconds' : seconds, 'calls' : calls } for stage, (seconds, calls) in stages.items() },
+               'runs' : runs }
+
+    with open(args.output, "w") as outputFile:
+        json.dump(report, outputFile, indent=1)
+
+    other = None
+    if args.compare:
+        with open(args.compare, "r") as otherFile:
+            other = json.load(otherFile)
+        if (other['phantom'], other['parameters']) != (report['phantom'], report['parameters']):
+            print(f"Note: {args.compare} was made with another phantom or other parameters.")
+
+    printTable(report, other)
+    print(f"Saved {args.output}")
+    return 0
+
+if __name__ == "__main__":
+    sys.exit(main())
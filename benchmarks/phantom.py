@@ -0,0 +1,170 @@
+import numpy as np
+import pydicom, os, sys, json, argparse
+from pydicom.dataset import Dataset, FileDataset, FileMetaDataset
+from pydicom.uid import generate_uid, ExplicitVRLittleEndian, CTImageStorage, RTStructureSetStorage
+
+# HU of the phantom materials
+HU_AIR = -1000
+HU_TISSUE = 0
+HU_LUNG = -700
+HU_BONE = 700
+
+def makeDataset(sopClassUID, sopInstanceUID):
+    meta = FileMetaDataset()
+    meta.MediaStorageSOPClassUID = sopClassUID
+    meta.MediaStorageSOPInstanceUID = sopInstanceUID
+    meta.TransferSyntaxUID = ExplicitVRLittleEndian
+
+    ds = FileDataset(None, {}, file_meta=meta, preamble=b"\0" * 128)
+    ds.SOPClassUID = sopClassUID
+    ds.SOPInstanceUID = sopInstanceUID
+    return ds
+
+def getLungCenter(matrixSize, pixelSpacing, side):
+    """Centre (x, y) [mm] of the left (side -1) or right (side 1) lung."""
+
+    return side * 0.35 * matrixSize * pixelSpacing / 2, 0
+
+def getTargetCenter(phase, numberOfPhases, matrixSize, pixelSpacing, amplitude):
+    """Centre (x, y) [mm] of the targets in a 4D phase: in the right lung, moving along y by up to amplitude over the breathing cycle."""
+
+    x, y = getLungCenter(matrixSize, pixelSpacing, 1)
+    return x, y + amplitude * (1 - np.cos(2 * np.pi * phase / numberOfPhases)) / 2
+
+def makeSliceImage(matrixSize, pixelSpacing, targetCenter, targetRadius):
+    """HU image of a slice: a tissue cylinder with two lungs, a spine and a tissue-equivalent target in the right lung."""
+
+    x = (np.arange(matrixSize) - (matrixSize - 1) / 2) * pixelSpacing
+    xx, yy = np.meshgrid(x, x)
+    size = matrixSize * pixelSpacing / 2 # mm, half the field of view
+
+    image = np.full((matrixSize, matrixSize), HU_AIR, dtype=np.int32)
+    image[(xx / 0.8)**2 + (yy / 0.56)**2 < size**2] = HU_TISSUE
+    for side in (-1, 1):
+        lungX, lungY = getLungCenter(matrixSize, pixelSpacing, side)
+        image[((xx - lungX) / 0.25)**2 + ((yy - lungY) / 0.4)**2 < size**2] = HU_LUNG
+    image[(np.abs(xx) < 0.06 * size) & (yy > 0.3 * size) & (yy < 0.5 * size)] = HU_BONE
+
+    image[(xx - targetCenter[0])**2 + (yy - targetCenter[1])**2 < targetRadius**2] = HU_TISSUE
+    return image
+
+def makeCircle(center, radius, z, numberOfPoints=64):
+    angles = np.linspace(0, 2 * np.pi, numberOfPoints, endpoint=False)
+    x = center[0] + radius * np.cos(angles)
+    y = center[1] + radius * np.sin(angles)
+    return [ float(k) for point in zip(x, y, [z] * numberOfPoints) for k in point ]
+
+def makePhantom(folder, matrixSize=512, numberOfSlices=40, numberOfPhases=2, pixelSpacing=0.98,
+                sliceThickness=2.5, targetRadius=15, targetMargin=5, targetLength=None, amplitude=10):
+    """Write a synthetic 4D CT with a matching RTSTRUCT, e.g. to benchmark the WEPL calculation.
+
+        The CT series of each 4D phase is written to folder/data/phase<N>, and the RS file, with a
+        GTV cylinder (targetRadius, targetLength mm, default half of the slices) and a PTV with the
+        same axis (targetRadius + targetMargin), to folder. The contours are those of the first phase;
+        the target moves by up to amplitude mm along y in the other phases. The geometry is saved in
+        folder/phantom.json. Returns the name of the RS file."""
+
+    dataFolder = os.path.join(folder, "data")
+    os.makedirs(dataFolder, exist_ok=True)
+
+    if targetLength is None:
+        targetLength = numberOfSlices * sliceThickness / 2
+    zCenter = (numberOfSlices - 1) * sliceThickness / 2
+
+    studyUID = generate_uid()
+    frameOfReferenceUID = generate_uid()
+    firstPhaseSlices = list() # (SOPInstanceUID, z) of the slices of the first phase
+
+    for phase in range(numberOfPhases):
+        phaseFolder = os.path.join(dataFolder, f"phase{phase}")
+        os.makedirs(phaseFolder, exist_ok=True)
+        seriesUID = generate_uid()
+        targetCenter = getTargetCenter(phase, numberOfPhases, matrixSize, pixelSpacing, amplitude)
+
+        for sliceIdx in range(numberOfSlices):
+            z = sliceIdx * sliceThickness
+            inTarget = abs(z - zCenter) <= targetLength / 2
+            image = makeSliceImage(matrixSize, pixelSpacing, targetCenter, inTarget and targetRadius or 0)
+
+            ds = makeDataset(CTImageStorage, generate_uid())
+            ds.Modality = "CT"
+            ds.StudyInstanceUID = studyUID
+            ds.SeriesInstanceUID = seriesUID
+            ds.FrameOfReferenceUID = frameOfReferenceUID
+            ds.SeriesDescription = f"{100 * phase / numberOfPhases:.1f}% AMP"
+            ds.StudyDate = "20200101"
+            ds.ImagePositionPatient = [-(matrixSize - 1) / 2 * pixelSpacing, -(matrixSize - 1) / 2 * pixelSpacing, z]
+            ds.ImageOrientationPatient = [1, 0, 0, 0, 1, 0]
+            ds.PixelSpacing = [pixelSpacing, pixelSpacing]
+            ds.SliceThickness = sliceThickness
+            ds.Rows = ds.Columns = matrixSize
+            ds.BitsAllocated = ds.BitsStored = 16
+            ds.HighBit = 15
+            ds.PixelRepresentation = 0
+            ds.SamplesPerPixel = 1
+            ds.PhotometricInterpretation = "MONOCHROME2"
+            ds.RescaleIntercept = -1024
+            ds.RescaleSlope = 1
+            ds.PixelData = (image + 1024).astype(np.uint16).tobytes()
+            ds.save_as(os.path.join(phaseFolder, f"CT.{ds.SOPInstanceUID}.dcm"), enforce_file_format=True)
+
+            if phase == 0:
+                firstPhaseSlices.append((ds.SOPInstanceUID, z))
+
+    rs = makeDataset(RTStructureSetStorage, generate_uid())
+    rs.Modality = "RTSTRUCT"
+    rs.StudyInstanceUID = studyUID
+    rs.FrameOfReferenceUID = frameOfReferenceUID
+
+    targets = { "GTV" : targetRadius, "PTV" : targetRadius + targetMargin }
+    roiList = list()
+    roiContourList = list()
+    for roiNumber, (name, radius) in enumerate(targets.items(), start=1):
+        roi = Dataset()
+        roi.ROINumber = roiNumber
+        roi.ROIName = name
+        roi.ReferencedFrameOfReferenceUID = frameOfReferenceUID
+        roiList.append(roi)
+
+        contourList = list()
+        for sopInstanceUID, z in firstPhaseSlices:
+            if abs(z - zCenter) > targetLength / 2:
+                continue # outside of the target, as in the images
+            contourImage = Dataset()
+            contourImage.ReferencedSOPClassUID = CTImageStorage
+            contourImage.ReferencedSOPInstanceUID = sopInstanceUID
+
+            contour = Dataset()
+            contour.ContourImageSequence = [contourImage]
+            contour.ContourGeometricType = "CLOSED_PLANAR"
+            contour.ContourData = makeCircle(getTargetCenter(0, numberOfPhases, matrixSize, pixelSpacing, amplitude), radius, z)
+            contour.NumberOfContourPoints = len(contour.ContourData) // 3
+            contourList.append(contour)
+
+        roiContour = Dataset()
+        roiContour.ReferencedROINumber = roiNumber
+        roiContour.ContourSequence = contourList
+        roiContourList.append(roiContour)
+
+    rs.StructureSetROISequence = roiList
+    rs.ROIContourSequence = roiContourList
+    structureFile = os.path.join(folder, f"RS.{rs.SOPInstanceUID}.dcm")
+    rs.save_as(structureFile, enforce_file_format=True)
+
+    geometry = { "matrixSize" : matrixSize, "numberOfSlices" : numberOfSlices, "numberOfPhases" : numberOfPhases,
+                 "pixelSpacing" : pixelSpacing, "sliceThickness" : sliceThickness, "targets" : targets,
+                 "targetLength" : targetLength, "amplitude" : amplitude, "structureFile" : os.path.basename(structureFile) }
+    with open(os.path.join(folder, "phantom.json"), "w") as geometryFile:
+        json.dump(geometry, geometryFile, indent=1)
+
+    return structureFile
+
+if __name__ == "__main__":
+    parser = argparse.ArgumentParser(description="Write a synthetic 4D CT phantom with a GTV and a PTV.")
+    parser.add_argument("folder", help="Output folder (the CT series are written to FOLDER/data)")
+    parser.add_argument("--matrix", type=int, default=512, help="Rows and columns of the images (default: %(default)s)")
+    parser.add_argument("--slices", type=int, default=40, help="Number of slices per phase (default: %(default)s)")
+    parser.add_argument("--phases", type=int, default=2, help="Number of 4D phases (default: %(default)s)")
+    args = parser.parse_args()
+
+    print(makePhantom(args.folder, args.matrix, args.slices, args.phases))
@@ -0,0 +1,96 @@
+import numpy as np
+import threading
+from collections import OrderedDict
+
+MASK_CACHE_SIZE = 256 * 2**20 # bytes
+SLICE_CACHE_SIZE = 512 * 2**20 # bytes
+
+class ArrayCache:
+    """Least recently used cache of arrays, limited by the memory they use.
+
+        The cached arrays are made read-only, since they are shared by all the users of the cache.
+        The hits and misses are counted, e.g. to tune the size. The cache can be used from several
+        threads, e.g. by the background thread of the IndexTracker."""
+
+    def __init__(self, maxBytes):
+        self.maxBytes = maxBytes
+        self.items = OrderedDict() # { key : (value, nbytes) }
+        self.nbytes = 0
+        self.hits = self.misses = 0
+        self.lock = threading.Lock()
+
+    def __len__(self):
+        return len(self.items)
+
+    def __contains__(self, key):
+        return key in self.items
+
+    def get(self, key):
+        """Returns the cached value, or None."""
+
+        with self.lock:
+            item = self.items.get(key)
+            if item is None:
+                self.misses += 1
+                return None
+
+            self.items.move_to_end(key)
+            self.hits += 1
+            return item[0]
+
+    def put(self, key, value, *arrays):
+        """Cache a value, whose memory use is that of the given arrays. Returns the value."""
+
+        nbytes = 0
+        for array in arrays:
+            array.flags.writeable = False
+            nbytes += array.nbytes
+
+        with self.lock:
+            if key in self.items:
+                self.nbytes -= self.items.pop(key)[1]
+
+            self.items[key] = (value, nbytes)
+            self.nbytes += nbytes
+            while self.nbytes > self.maxBytes and len(self.items) > 1:
+                key, (evicted, evictedBytes) = self.items.popitem(last=False)
+                self.nbytes -= evictedBytes
+
+        return value
+
+    def clear(self):
+        with self.lock:
+            self.items.clear()
+            self.nbytes = 0
+            self.hits = self.misses = 0
+
+class MaskCache(ArrayCache):
+    """Cache of rasterized structure masks.
+
+        The masks are stored as flat pixel indices, so that the memory scales with the structure size
+        and not with the image size. One instance per process is shared by all series, so that the
+        4D phases sharing an external structure file (same contours on the same grid) rasterize
+        each mask only once."""
+
+    def __init__(self, maxBytes=MASK_CACHE_SIZE):
+        super().__init__(maxBytes)
+
+    def getIndices(self, key, makeMask):
+        """Returns the flat indices (row-major) of the pixels inside a mask, calling makeMask() on a miss."""
+
+        indices = self.get(key)
+        if indices is None:
+            indices = np.flatnonzero(makeMask()).astype(np.int32)
+            self.put(key, indices, indices)
+        return indices
+
+class SliceCache(ArrayCache):
+    """Cache of the decoded HU images of the CT files, with their (pixel-less) DICOM headers.
+
+        One instance per process is shared by all series, the viewer and the WEPL calculation."""
+
+    def __init__(self, maxBytes=SLICE_CACHE_SIZE):
+        super().__init__(maxBytes)
+
+maskCache = MaskCache()
+sliceCache = SliceCache()
@@ -0,0 +1,101 @@
+import numpy as np
+import os, hashlib
+
+LUT_MIN, LUT_MAX = -32768, 32767 # The lookup table covers all int16 HU values
+
+class Calibration:
+    """Piecewise linear HU - RSP calibration curve, applied to integer images through a lookup table.
+
+        The curve is a list of segments (from HU, intercept, slope), sorted by HU: each segment is used from
+        its HU up to the next one, and the first and last segments are extended to all HU values. The RSP
+        of every int16 HU value is tabulated once, so that converting an integer image is a single gather
+        into the output, without temporary arrays; other images are evaluated segment by segment."""
+
+    def __init__(self, name, segments):
+        self.name = name
+        self.segments = [ (float(huFrom), float(intercept), float(slope)) for huFrom, intercept, slope in segments ]
+        self.breaks = np.array([ k[0] for k in self.segments[1:] ], dtype=float)
+        self.intercepts = np.array([ k[1] for k in self.segments ], dtype=float)
+        self.slopes = np.array([ k[2] for k in self.segments ], dtype=float)
+
+        # Index HU mod 2**16, so that an int16 image can index the table through a uint16 view
+        self.lut = np.roll(self.evaluate(np.arange(LUT_MIN, LUT_MAX + 1)), LUT_MIN)
+        self.luts = { self.lut.dtype : self.lut }
+
+    @classmethod
+    def fromFile(cls, fileName):
+        """Read a curve from a text file with "HU,RSP" lines (sorted by HU), linearly interpolated between the points.
+
+            Lines starting with # and lines which are not numbers (e.g. a header) are skipped. Two points
+            with the same HU make a step, e.g. between two calibration lines."""
+
+        points = list()
+        with open(fileName, "r") as calibrationFile:
+            for line in calibrationFile.readlines():
+                if line.lstrip().startswith("#"):
+                    continue
+                try:
+                    hu, rsp = [ float(k) for k in line.split(",")[:2] ]
+                except ValueError:
+                    continue
+                points.append((hu, rsp))
+
+        segments = list()
+        for (hu0, rsp0), (hu1, rsp1) in zip(points[:-1], points[1:]):
+            if hu1 < hu0:
+                raise ValueError(f"The HU values in {fileName} are not sorted.")
+            if hu1 == hu0:
+                continue
+            slope = (rsp1 - rsp0) / (hu1 - hu0)
+            segments.append((hu0, rsp0 - slope * hu0, slope))
+
+        if not segments:
+            raise ValueError(f"Need at least two points with different HU in {fileName}.")
+
+        name = os.path.splitext(os.path.basename(fileName))[0]
+        return cls(name, segments)
+
+    def getId(self):
+        """Name and hash of the curve, e.g. to record with the results."""
+
+        curveHash = hashlib.sha1(repr(self.segments).encode()).hexdigest()[:12]
+        return f"{self.name}-{curveHash}"
+
+    def evaluate(self, image):
+        image = np.asarray(image)
+        idx = np.searchsorted(self.breaks, image, side='right')
+        return self.intercepts[idx] + self.slopes[idx] * image
+
+    def getLUT(self, dtype):
+        """The lookup table in the given float type."""
+
+        dtype = np.dtype(dtype)
+        if not dtype in self.luts:
+            self.luts[dtype] = self.lut.astype(dtype)
+        return self.luts[dtype]
+
+    def convert(self, image, out=None):
+        """RSP of an image or a volume, written to out if given (float64 or float32)."""
+
+        image = np.asarray(image)
+        if out is None:
+            out = np.empty(np.shape(image), dtype=float)
+
+        if image.dtype == np.int16:
+            np.take(self.getLUT(out.dtype), image.view(np.uint16), out=out, mode='wrap')
+        elif np.issubdtype(image.dtype, np.integer):
+            np.take(self.getLUT(out.dtype), np.clip(image, LUT_MIN, LUT_MAX), out=out, mode='wrap')
+        else:
+            out[...] = self.evaluate(image)
+
+        return out
+
+# Schneider et al., PMB 41(1) (1996): two lines, with a step at 200 HU
+schneiderCalibration = Calibration("Schneider1996", [(-np.inf, 1.02365, 0.00100547), (200, 1.06037, 0.00046761)])
+
+def loadCalibration(fileName=None):
+    """The calibration in fileName, or the Schneider calibration if none."""
+
+    if not fileName:
+        return schneiderCalibration
+    return Calibration.fromFile(fileName)
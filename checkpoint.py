@@ -0,0 +1,46 @@
+import numpy as np
+import os, json, hashlib
+
+class ResultStore:
+    """On-disk store of the WEPL results of a run, with one file per (series, slice, rotation) work unit.
+
+        Each result is written as soon as it is calculated, so that a run which is stopped can be
+        continued: the units found in the store are read instead of calculated again. The store of a
+        run is a subfolder named by the hash of the run parameters (structures, registration, method...),
+        which are also saved in its manifest.json."""
+
+    def __init__(self, folder, parameters):
+        runHash = hashlib.sha1(json.dumps(parameters, sort_keys=True).encode()).hexdigest()[:16]
+        self.folder = os.path.join(folder, f"run_{runHash}")
+        os.makedirs(self.folder, exist_ok=True)
+
+        manifestFile = os.path.join(self.folder, "manifest.json")
+        if not os.path.exists(manifestFile):
+            with open(manifestFile, "w") as manifest:
+                json.dump(parameters, manifest, indent=1, sort_keys=True)
+
+    def getFileName(self, seriesPath, zpos, rot):
+        seriesHash = hashlib.sha1(os.path.abspath(seriesPath).encode()).hexdigest()[:16]
+        return os.path.join(self.folder, seriesHash, f"z{float(zpos):+.3f}_r{float(rot):.3f}.npz")
+
+    def contains(self, seriesPath, zpos, rot):
+        return os.path.exists(self.getFileName(seriesPath, zpos, rot))
+
+    def write(self, seriesPath, zpos, rot, studyDate, weplList):
+        """Save the result of a work unit (atomically, so that a partial file is never read back)."""
+
+        fileName = self.getFileName(seriesPath, zpos, rot)
+        os.makedirs(os.path.dirname(fileName), exist_ok=True)
+
+        arrays = { f"wepl{idx}" : np.asarray(wepl) for idx, wepl in enumerate(weplList) }
+        with open(fileName + ".tmp", "wb") as partition:
+            np.savez(partition, studyDate=np.array(str(studyDate)), **arrays)
+        os.replace(fileName + ".tmp", fileName)
+
+    def read(self, seriesPath, zpos, rot):
+        """Returns the study date and the WEPL values per contour of a saved work unit."""
+
+        with np.load(self.getFileName(seriesPath, zpos, rot)) as partition:
+            studyDate = str(partition["studyDate"])
+            weplList = [ partition[f"wepl{idx}"] for idx in range(len(partition.files) - 1) ]
+        return studyDate, weplList
@@ -4,9 +4,70 @@ from scipy.ndimage.interpolation import rotate
 from mpl_toolkits.axes_grid1.axes_divider import make_axes_locatable
 from math import *
 import matplotlib.patches as patches
-import pydicom, os
+import pydicom, os, hashlib, copy
+from concurrent.futures import ThreadPoolExecutor
+
+from cache import ArrayCache, sliceCache
+from sharedvolume import getVolumeDtype
+from volumecache import openVolumeCache
+from calibration import schneiderCalibration
+from rotation import getSplineCoefficients, rotateCoefficients
+from profiling import stageProfile
+
+def integrateWEPL(imageRSP, pixelSpacing, out=None):
+    """Cumulative WEPL along the image rows (beam entering from the top) of one or more RSP images.
+
+        imageRSP has the shape (..., rows, columns), e.g. (angles, rows, columns) or (phases, rows, columns)
+        for a batch of slices, and pixelSpacing is a number or one value per image. The result is written
+        to out if given (a preallocated array of the same shape), without any other allocations."""
+
+    imageRSP = np.asarray(imageRSP)
+    pixelSpacing = np.asarray(pixelSpacing, dtype=float)
+    if pixelSpacing.ndim:
+        pixelSpacing = pixelSpacing.reshape(pixelSpacing.shape + (1, 1))
+
+    if out is None:
+        out = np.empty(np.shape(imageRSP), dtype=np.result_type(imageRSP, np.float32))
+
+    np.multiply(imageRSP, pixelSpacing, out=out)
+    np.cumsum(out, axis=-2, out=out)
+
+    return out
+
+def convertHUToRSP(image, calibration = None, out = None):
+    """HU - RSP calibration of an image or a volume, written to out if given.
+
+        Uses a Calibration from calibration.py, by default Schneider et al., PMB 41(1) (1996)."""
+
+    return (calibration or schneiderCalibration).convert(image, out)
+
+def rotateVolume(volume, angle, out=None, coefficients=None, window=None):
+    """Rotate all slices of a (slices, rows, columns) volume about the z axis.
+
+        Gives the same images as Series.rotateImage on each slice, in a single call. When rotating
+        the volume by several angles, pass its spline coefficients (rotation.getSplineCoefficients),
+        so that they are not made again for each angle; only the pixels in the window (slices of rows
+        and columns) of the rotated slices are then interpolated, if one is given."""
+
+    if coefficients is None:
+        return rotate(volume, angle=angle, axes=(1, 2), reshape=False, cval=-1000, output=out)
+
+    return rotateCoefficients(coefficients, angle, out, window, volume.dtype)
+
+VIEWER_CACHE_SIZE = 128 * 2**20 # bytes of calculated slices kept by the IndexTracker
+VIEWER_PREFETCH = 2 # slices calculated ahead in the scroll direction
+VIEWER_DEBOUNCE = 40 # ms without scrolling before a slice is drawn
 
 class IndexTracker(object):
+    """Scroll through the slices of a series, showing the HU, RSP and WEPL images with the contours.
+
+        The slices are calculated by a background thread, on its own copy of the series, and kept in
+        a small LRU cache; after each slice is drawn, the next slices in the scroll direction are
+        calculated ahead. A burst of scroll events is drawn once, when the scrolling stops.
+
+        The images, contour lines and slice label are animated artists, which are updated in place and
+        blitted over the saved background of the figure, so that each update is a single redraw."""
+
     def __init__(self, ax1, ax2, ax3, imageSeries, extStructFile, options, rotations):
         self.ax1 = ax1
         self.ax2 = ax2
@@ -35,7 +96,6 @@ class IndexTracker(object):
             self.imageSeries.loadImageFromUID(self.UIDs[self.ind])
 
         self.imageSeries.resetImage()   
-        self.ax1.set_title(imageSeries.amplitude)
 
         self.im1 = self.ax1.imshow(self.imageSeries.image, cmap="gray")
         self.im2 = self.ax2.imshow(self.imageSeries.image, vmin=0, vmax=2, cmap="gray")
@@ -48,73 +108,174 @@ class IndexTracker(object):
         ax3_divider = make_axes_locatable(self.ax3)
         cax3 = ax3_divider.append_axes("right", size="7%", pad="2%")
         self.cb3 = plt.colorbar(self.im3, cax=cax3)
-        
+
+        self.ax1.set_title('Hounsfield Units')
+        self.ax2.set_title('Relative Stopping Power')
+        self.ax3.set_title(f'Water Equivalent Path Length (beam angle = {self.rot}°)')
+
+        # One legend entry per structure, and a list of persistent lines per structure for its contours
+        self.contourLines = { structure : list() for structure in self.structures }
+        for structure in self.structures:
+            self.ax1.plot([], [], color=self.structureColor[structure], label=structure)
+        self.legend = self.structures and self.ax1.legend() or None
+
+        # The y label is drawn with the axis, so the slice label is a text at its place, see ondraw
+        ylabel = self.ax1.yaxis.label
+        self.sliceLabel = self.ax1.text(0, 0.5, "", transform=ylabel.get_transform(), rotation=90, rotation_mode='anchor',
+                                        ha='center', va='bottom', fontproperties=ylabel.get_fontproperties(), clip_on=False)
+
+        self.animatedArtists = [ self.im1, self.im2, self.im3, self.sliceLabel ]
+        self.animatedArtists += [ spine for ax in (self.ax1, self.ax2, self.ax3) for spine in ax.spines.values() ]
+        if self.legend:
+            self.animatedArtists.append(self.legend)
+        for artist in self.animatedArtists:
+            artist.set_animated(True)
+        self.background = None
+
+        # The background thread works on its own copy of the series, sharing the read-only images and contours
+        self.frameSeries = copy.copy(self.imageSeries)
+        self.frames = ArrayCache(VIEWER_CACHE_SIZE) # { slice index : frame }, see calculateFrame
+        self.pendingFrames = dict() # { slice index : Future of the frame }
+        self.executor = ThreadPoolExecutor(max_workers=1)
+        self.direction = 1
+
+        canvas = self.ax1.figure.canvas
+        self.debounceTimer = canvas.new_timer(interval=VIEWER_DEBOUNCE)
+        self.debounceTimer.single_shot = True
+        self.debounceTimer.add_callback(self.update)
+        canvas.mpl_connect('close_event', self.onclose)
+        canvas.mpl_connect('draw_event', self.ondraw)
 
         self.update()
     
     def onscroll(self, event):
         if event.button == 'up':
+            self.direction = 1
             self.ind = (self.ind + 1)
             if self.ind >= len(self.imgList):
                 self.ind = 0
         else:
+            self.direction = -1
             self.ind = (self.ind - 1)
             if self.ind < 0:
                 self.ind = len(self.imgList) - 1
-        self.update()
 
-    def update(self):
+        # Draw only when the scrolling stops
+        self.debounceTimer.stop()
+        self.debounceTimer.start()
+
+    def ondraw(self, event):
+        """Save the background (all but the animated artists) after a full draw, e.g. when the window is resized."""
+
+        self.sliceLabel.set_x(self.ax1.yaxis.label.get_position()[0])
+
+        canvas = self.ax1.figure.canvas
+        if canvas.supports_blit:
+            self.background = canvas.copy_from_bbox(self.ax1.figure.bbox)
+        self.drawAnimatedArtists()
+
+    def drawAnimatedArtists(self):
+        figure = self.ax1.figure
+        for artist in sorted(self.animatedArtists, key=lambda artist: artist.get_zorder()):
+            figure.draw_artist(artist)
+
+    def redraw(self):
+        """Draw the animated artists over the saved background, in one blit, or draw the figure if there is none."""
+
+        canvas = self.ax1.figure.canvas
+        if self.background is None:
+            canvas.draw_idle()
+            return
+
+        canvas.restore_region(self.background)
+        self.drawAnimatedArtists()
+        canvas.blit(self.ax1.figure.bbox)
+        canvas.flush_events()
+
+    def setContourLines(self, structure, contours):
+        """Show the contours (X, Y) of a structure, reusing its lines and hiding the ones not needed."""
+
+        lines = self.contourLines[structure]
+        X, Y = contours
+        while len(lines) < len(X):
+            line, = self.ax1.plot([], [], color=self.structureColor[structure], animated=True, scalex=False, scaley=False)
+            lines.append(line)
+            self.animatedArtists.append(line)
+
+        for idx, line in enumerate(lines):
+            if idx < len(X):
+                line.set_data(X[idx], Y[idx])
+            line.set_visible(idx < len(X))
+
+    def onclose(self, event):
+        self.debounceTimer.stop()
+        self.executor.shutdown(wait=False, cancel_futures=True)
+
+    def calculateFrame(self, ind):
+        """Calculate slice ind for update, in the background thread.
+
+            Returns the z position, the HU, RSP and WEPL images and the contours (X, Y) per structure."""
+
+        s = self.frameSeries
         if self.extStructFile:
-            self.UIDs = self.extStructFile.getUIDsFromStructures()
-            self.imgList = self.zposList = sorted(self.extStructFile.getZposFromStructures())
-            self.imageSeries.loadImageFromPosZ(self.zposList[self.ind])
+            s.loadImageFromPosZ(self.zposList[ind])
         else:
-            self.imgList = self.UIDs = sorted(self.imageSeries.getUIDsFromStructures())
-            self.imageSeries.loadImageFromUID(self.UIDs[self.ind])
-            
-        self.imageSeries.resetImage()
-        self.imageSeries.rotateImage(self.rot)
-        self.imageSeries.recalculateContourBounds()        
-        self.imageSeries.convertImageToRSP()
-        self.imageSeries.convertImageToWEPL()
-        self.imageSeries.rotateImage(-self.rot)
+            s.loadImageFromUID(self.UIDs[ind])
 
-        self.im1.set_data(self.imageSeries.image)
-        self.im2.set_data(self.imageSeries.imageRSP)
-        self.im3.set_data(self.imageSeries.imageWEPL)
+        s.resetImage()
+        s.rotateImage(self.rot)
+        s.recalculateContourBounds()
+        s.convertImageToRSP()
+        s.convertImageToWEPL()
+        s.rotateImage(-self.rot)
 
-        
-        
-        self.ax1.set_ylabel('slice %s; z = %.1f' % (self.ind, self.imageSeries.zpos))
+        contours = list()
+        for structure in self.structures:
+            s.structure = structure
+            contours.append((structure, s.getStructuresInImageCoordinates()))
 
-        self.ax1.lines = []
-        rot = 0
+        return s.zpos, s.image, s.imageRSP, s.imageWEPL, contours
 
-        for structure in self.structures:
-            self.imageSeries.structure = structure
-            #try:
-                # self.imageSeries.dicomRotation = self.rot
-            #self.imageSeries.loadStructures()
-            contours = self.imageSeries.getStructuresInImageCoordinates()
-
-            #except:
-                #continue
-
-            first = True
-            for contourX, contourY in zip(*contours):
-                labelText = first and structure or None
-                self.ax1.plot(contourX, contourY, color=self.structureColor[structure], label=labelText)
-                first = False
-                
-        plt.legend()
-        self.im1.axes.figure.canvas.draw()
-        self.im2.axes.figure.canvas.draw()
-        self.im3.axes.figure.canvas.draw()
-
-        self.lines = list()
-        self.ax1.set_title('Hounsfield Units')
-        self.ax2.set_title('Relative Stopping Power')
-        self.ax3.set_title(f'Water Equivalent Path Length (beam angle = {self.rot}°)')
+    def getFrame(self, ind):
+        """The calculated slice ind, from the cache, from the background thread, or calculated now."""
+
+        frame = self.frames.get(ind)
+        if frame is None:
+            future = self.pendingFrames.pop(ind, None) or self.executor.submit(self.calculateFrame, ind)
+            frame = future.result()
+            self.frames.put(ind, frame, *frame[1:4])
+        return frame
+
+    def prefetch(self):
+        """Calculate the next VIEWER_PREFETCH slices in the scroll direction in the background thread."""
+
+        wanted = [ (self.ind + k * self.direction) % len(self.imgList) for k in range(1, VIEWER_PREFETCH + 1) ]
+
+        for ind, future in list(self.pendingFrames.items()):
+            if future.done():
+                self.frames.put(ind, future.result(), *future.result()[1:4])
+                del self.pendingFrames[ind]
+            elif not ind in wanted and future.cancel():
+                del self.pendingFrames[ind]
+
+        for ind in wanted:
+            if not ind in self.frames and not ind in self.pendingFrames:
+                self.pendingFrames[ind] = self.executor.submit(self.calculateFrame, ind)
+
+    def update(self):
+        zpos, image, imageRSP, imageWEPL, contoursPerStructure = self.getFrame(self.ind)
+
+        self.im1.set_data(image)
+        self.im2.set_data(imageRSP)
+        self.im3.set_data(imageWEPL)
+
+        self.sliceLabel.set_text('slice %s; z = %.1f' % (self.ind, zpos))
+
+        for structure, contours in contoursPerStructure:
+            self.setContourLines(structure, contours)
+
+        self.redraw()
+        self.prefetch()
 """
         self.X = X
         self.slices, cols, rows = X.shape
@@ -126,87 +287,88 @@ class IndexTracker(object):
         self.update()
 """
 
-class Line:
-    """Used to aid in the pixels in structure calculation."""
-    
-    def __init__(self, x0, y0, x1, y1):
-        self.x0, self.y0 = x0, y0
-        self.x1, self.y1 = x1, y1        
-        
-        if (y1 == y0):  self.dxdy = 0
-        else:           self.dxdy = (x1 - x0) / (y1 - y0)
-        
-        if (x1 == x0):  self.dydx = 1e5
-        else:           self.dydx = (y1 - y0) / (x1 - x0)
-
-    def findIntercept(self, x=None, y=None):
-        if x:
-            if self.x0 < x <= self.x1:
-                return (x-self.x0) * self.dydx + self.y0
-            elif self.x1 < x <= self.x0:
-                return (x-self.x0) * self.dydx + self.y0
-    
-        elif y:
-            if self.y0 < y <= self.y1:
-                return (y-self.y0)* self.dxdy + self.x0
-            elif self.y1 < y <= self.y0:
-                return (y-self.y0) * self.dxdy + self.x0
-            
-        return None
-
-class LinearContour:
-    """Calculate which pixels are contained in structures."""
-    
-    def __init__(self, dicomTranslation, pixelSpacing):
-        self.lines = list()
-        self.dicomTranslation = dicomTranslation
-        self.pixelSpacing = pixelSpacing
-        self.xmin = self.ymin = self.xmax = self.ymax = None
-
-    def addLines(self, listOfPoints):
-        lastPoint = listOfPoints[-1]
-        self.xmin = self.xmax = lastPoint[0]
-        self.ymin = self.ymax = lastPoint[1]
-        
-        for point in listOfPoints:
-            self.xmin = min(self.xmin, point[0])
-            self.ymin = min(self.ymin, point[1])
-            self.xmax = max(self.xmax, point[0])
-            self.ymax = max(self.ymax, point[1])
-            
-            self.lines.append(Line(*lastPoint, *point))
-            lastPoint = point
-
-    def getInterceptingLines(self, x=None, y=None):
-        interceptPoints = []
-        for line in self.lines:
-            intercept = line.findIntercept(x,y)
-            if intercept:
-                interceptPoints.append(intercept)
-
-        return interceptPoints   
-
-    def findPixelInsideContourColumn(self, x, sh):
-        column = np.zeros(sh[0])
-        ray = self.getInterceptingLines(x, None)
-
-        yRangesInsideContour = []
-        for k in range(int((len(ray)+1)/2)):
-            yRangesInsideContour.append([int(ray[2*k]), int(ray[2*k+1]+1)])
-        
-        for yFrom, yTo in yRangesInsideContour:
-            ymin, ymax = sorted([yFrom, yTo])
-            column[ymin:ymax] = True
-
-        return column
-    
-    def getListOfPixelsInContour(self, image):
-        sh = np.shape(image)
-        contourMap = np.zeros(sh, dtype="bool")
-        for x in range(int(self.xmin), int(self.xmax+1)):
-            contourMap[:,x] = self.findPixelInsideContourColumn(x, sh)
-            
-        return contourMap
+def rasterizePolygon(contourX, contourY, shape):
+    """Boolean mask of the pixels inside a closed contour (even-odd rule), for an image of the given shape.
+
+        The contour vertices are in image coordinates (x = column, y = row). For each column of the
+        bounding box, the edges crossing it are found at once, and the parity of the crossings
+        above each pixel centre is accumulated along the rows."""
+
+    x = np.asarray(contourX, dtype=float)
+    y = np.asarray(contourY, dtype=float)
+    mask = np.zeros(shape[:2], dtype=bool)
+    if len(x) < 3:
+        return mask
+
+    nRows, nCols = shape[:2]
+    colFrom = max(0, int(np.ceil(np.min(x))))
+    colTo = min(nCols - 1, int(np.floor(np.max(x))))
+    rowFrom = max(0, int(np.ceil(np.min(y))))
+    rowTo = min(nRows - 1, int(np.floor(np.max(y))))
+    if colFrom > colTo or rowFrom > rowTo:
+        return mask
+
+    x0, y0 = x, y
+    x1, y1 = np.roll(x, -1), np.roll(y, -1)
+    cols = np.arange(colFrom, colTo + 1)[:, np.newaxis]
+
+    # Half-open test, so that a vertex on a column is only counted once
+    crossing = (np.minimum(x0, x1) < cols) & (cols <= np.maximum(x0, x1))
+    colIdx, edgeIdx = np.nonzero(crossing)
+    e0x, e0y, e1x, e1y = x0[edgeIdx], y0[edgeIdx], x1[edgeIdx], y1[edgeIdx]
+    intercept = e0y + (cols[colIdx, 0] - e0x) * (e1y - e0y) / (e1x - e0x)
+
+    # Toggle the inside / outside state from the first pixel centre below each crossing
+    toggleRow = np.clip(np.ceil(intercept).astype(int) - rowFrom, 0, rowTo - rowFrom + 1)
+    toggles = np.zeros((rowTo - rowFrom + 2, colTo - colFrom + 1), dtype=np.int32)
+    np.add.at(toggles, (toggleRow, colIdx), 1)
+
+    mask[rowFrom:rowTo+1, colFrom:colTo+1] = np.cumsum(toggles[:-1], axis=0) & 1
+    return mask
+
+class SeriesCatalog:
+    """Index of the image files of a series, made once from their headers.
+
+        The slices are sorted by z position, so that the slice nearest to a position is found by
+        bisection for any file order and slice spacing. Also maps SOPInstanceUID to file, and keeps
+        the descriptions of the series."""
+
+    def __init__(self, fileNames, readHeader, translationZ = 0):
+        zposList = list()
+        self.fileFromUID = dict()
+        self.names = dict() # { "SeriesDescription (StudyDate)" : number of slices }
+        self.seriesDescription = None
+        self.sliceThickness = None
+
+        for fileName in fileNames:
+            ds = readHeader(fileName)
+            zposList.append(ds.ImagePositionPatient[2] + translationZ)
+            self.fileFromUID[ds.SOPInstanceUID] = fileName
+
+            if self.seriesDescription is None:
+                self.seriesDescription = ds.SeriesDescription
+                self.sliceThickness = ds.SliceThickness
+                self.names[f"{ds.SeriesDescription} ({ds.StudyDate})"] = len(fileNames)
+
+        order = np.argsort(zposList, kind='stable')
+        self.zpos = np.array(zposList, dtype=float)[order]
+        self.files = [ fileNames[k] for k in order ]
+        self.indexFromFile = { fileName : idx for idx, fileName in enumerate(self.files) }
+
+    def __len__(self):
+        return len(self.files)
+
+    def findNearestIndex(self, zpos):
+        idx = int(np.searchsorted(self.zpos, zpos))
+        if idx == len(self.zpos) or idx > 0 and zpos - self.zpos[idx-1] <= self.zpos[idx] - zpos:
+            return idx - 1
+        return idx
+
+    def getNearestFile(self, zpos):
+        return self.files[self.findNearestIndex(zpos)]
+
+    def getFileFromUID(self, UID):
+        return self.fileFromUID.get(UID)
 
 class Series:
     """Load DS and RS images from DICOM folder.
@@ -216,7 +378,16 @@ class Series:
     def __init__(self, path = None, zpos = None, translation = None, rs = None, options = None):
         self.path = path
         self.zpos = zpos
-        self.zposLUT = dict()
+        self.catalog = None
+        self.headers = dict()
+        self.volumeCacheFolder = None # set by setVolumeCache until the volume is opened
+        self.volumeCacheFile = None
+        self.volume = None
+        self.contourFilter = None
+        self.calibration = None
+        self.compactPrecision = False
+        self.imageIsHU = False # self.image is an unrotated copy of self.imageHU
+        self.splineCoefficients = None # (imageHU, its spline coefficients) of the last rotated slice
         self.structures = list()
         self.translation = translation
         self.dicomTranslation = None
@@ -230,9 +401,11 @@ class Series:
         self.ds = None
         self.extStructFile = None
         self.image = None
+        self.imageHU = None
+        self.imageShape = None
         self.imageWEPL = None
         self.imageRSP = None
-        self.zlim = []
+        self.sliceThickness = None
         self.contourWEPL = list()
         self.pixelSpacing = None
         self.imageUID = None
@@ -246,76 +419,128 @@ class Series:
         if rs:
             self.rs = pydicom.dcmread(rs)
 
-    def loadImages(self, load_rs):
-        self.fDS, fRS = list(), list()
-        for (dirpath, dirnames, filenames) in os.walk(self.path):
-            self.fDS += [os.path.join(dirpath, file) for file in filenames if "CT" in file]
-            fRS += [os.path.join(dirpath, file) for file in filenames if "RS" in file]
+    def __getstate__(self):
+        """Pickle without the DICOM datasets, images and (Tk) options, e.g. for worker processes.
+
+            The selected contours and the image index are kept, so that slices can be loaded again."""
 
-        if load_rs:
+        state = self.__dict__.copy()
+        for key in ['ds', 'rs', 'extStructFile', 'options', 'image', 'imageHU', 'imageRSP', 'imageWEPL', 'volume', 'splineCoefficients']:
+            state[key] = None
+        return state
+
+    def loadImages(self, load_rs, headerIndex = None):
+        """Find the CT and RS files below self.path, by their Modality if a (discovered) header index is given."""
+
+        if headerIndex:
+            self.fDS, fRS = headerIndex.getSeriesFiles(self.path)
+            self.headers = { fDS : headerIndex.headers[fDS] for fDS in self.fDS }
+        else:
+            self.fDS, fRS = list(), list()
+            for (dirpath, dirnames, filenames) in os.walk(self.path):
+                self.fDS += [os.path.join(dirpath, file) for file in filenames if "CT" in file]
+                fRS += [os.path.join(dirpath, file) for file in filenames if "RS" in file]
+
+        if load_rs and fRS:
             self.rs = pydicom.dcmread(fRS[0])
-        if self.zpos:
-            self.loadImageFromPosZ()
 
         self.makeImageIndex()
 
+        if self.zpos:
+            self.loadImageFromPosZ(self.zpos)
+
+    def readHeader(self, fileName):
+        """Returns the header of an image file, from the header index if it was loaded with one."""
+
+        if fileName in self.headers:
+            return self.headers[fileName]
+        return pydicom.dcmread(fileName, stop_before_pixels=True)
+
     def getAllDatesAndSeriesDescription(self):
-        names = dict()
-        for dsFile in self.fDS:
-            try:
-                ds = pydicom.dcmread(dsFile, stop_before_pixels=True)
-                name = f"{ds.SeriesDescription} ({ds.StudyDate})"
-                if not name in names.keys():
-                    names[name] = len(self.fDS)
-                break
-            except:
-                continue
-            
-        return names
+        if not self.catalog:
+            return dict()
+        return dict(self.catalog.names)
 
     def makeImageIndex(self):
-        self.zposLUT = dict()
-        
-        for fDS in self.fDS:
-            ds = pydicom.dcmread(fDS, stop_before_pixels=True)
-            zpos = ds.ImagePositionPatient[2] + self.translation[2]
-            self.zposLUT[zpos] = fDS
-            if not self.amplitude:
-                self.amplitude = ds.SeriesDescription
+        """Make the catalog of the image files. The files (self.fDS) are sorted by z position."""
+
+        self.catalog = SeriesCatalog(self.fDS, self.readHeader, self.translation[2])
+        self.fDS = self.catalog.files
+        self.amplitude = self.amplitude or self.catalog.seriesDescription
+        self.sliceThickness = self.catalog.sliceThickness
     
     def findImageIndex(self, zpos=None):
         if zpos == None:
             zpos = self.zpos
 
-        if not self.zlim:
-            first = pydicom.dcmread(self.fDS[0], stop_before_pixels=True)
-            last = pydicom.dcmread(self.fDS[-1], stop_before_pixels=True)
-
-            zlim = [k.ImagePositionPatient[2] + self.translation[2] for k in [first,last]]        
-            deltaz = copysign(first.SliceThickness, zlim[1] - zlim[0])
-
-            self.zlim = zlim
-            self.deltaz = deltaz
-            self.sliceThickness = first.SliceThickness
-            
-        return int((zpos - self.zlim[0])/self.deltaz + 0.5)
+        return self.catalog.findNearestIndex(zpos)
 
     def setUIDFromZ(self, zpos):
         idx = self.findImageIndex(zpos)
-        self.ds = pydicom.dcmread(self.fDS[idx], stop_before_pixels=True)
+        self.ds = self.readHeader(self.fDS[idx])
         self.pixelSpacing = float(self.ds.PixelSpacing[0])
         self.dicomTranslation = [float(k) for k in self.ds.ImagePositionPatient]
         self.imageUID = self.ds.SOPInstanceUID
 
-    def loadImageFromUID(self, UID):
-        UIDidxInFDS = 0
-        for idx,k in enumerate(self.fDS):
-            if UID in k:
-                UIDidxInFDS = idx
+    def setVolumeCache(self, cacheFolder):
+        """Read the images from a memory mapped HU volume in cacheFolder.
+
+            The volume is opened, and (re)written if the files have changed, when the first slice is
+            loaded, so that the series which are not used are not decoded."""
 
-        assert UIDidxInFDS
+        self.volumeCacheFolder = cacheFolder
+        self.volumeCacheFile = None
+        self.volume = None
+
+    def openVolumeCache(self):
+        """Open the volume set by setVolumeCache, if not done yet, e.g. before the series is sent to worker processes."""
+
+        if self.volumeCacheFolder:
+            self.volumeCacheFile = openVolumeCache(self.volumeCacheFolder, self.path, self.fDS)
+            self.volumeCacheFolder = None
+
+    def getVolumeDtype(self):
+        """Smallest integer type holding the HU values of the loaded image."""
+
+        if self.volumeCacheFile:
+            return self.imageHU.dtype
+        return getVolumeDtype(self.ds)
+
+    def loadSlice(self, fileName):
+        """Set self.ds and self.imageHU from an image file, decoding it only if it is not in the slice cache.
+
+            With a volume cache, the HU image is a read-only view into the memory mapped volume instead,
+            and self.ds holds only the (indexed) header.
+            The pixel data is removed from the cached header, and the HU image is read-only, of the
+            smallest integer type holding its values."""
+
+        self.openVolumeCache()
+        if self.volumeCacheFile:
+            with stageProfile.measure("read volume cache"):
+                if self.volume is None:
+                    self.volume = np.load(self.volumeCacheFile, mmap_mode='r')
+                self.ds = self.readHeader(fileName)
+                self.imageHU = self.volume[self.catalog.indexFromFile[fileName]]
+            return
+
+        cached = sliceCache.get(fileName)
+        if cached is None:
+            with stageProfile.measure("read DICOM"):
+                ds = pydicom.dcmread(fileName)
+            with stageProfile.measure("decode pixels"):
+                imageHU = np.array(ds.pixel_array, dtype='int')
+                imageHU += int(ds.RescaleIntercept)
+                imageHU = imageHU.astype(getVolumeDtype(ds))
+            del ds.PixelData
+            cached = sliceCache.put(fileName, (ds, imageHU), imageHU)
+
+        self.ds, self.imageHU = cached
+
+    def loadImageFromUID(self, UID):
+        fileName = self.catalog.getFileFromUID(UID)
+        assert fileName, f"No image with SOPInstanceUID {UID} in {self.path}"
         
-        self.ds = pydicom.dcmread(self.fDS[UIDidxInFDS])
+        self.loadSlice(fileName)
         assert self.ds.SOPInstanceUID == UID
 
         self.zpos = self.ds.ImagePositionPatient[2] + self.translation[2]
@@ -325,26 +550,13 @@ class Series:
         self.resetImage()
         
     def loadImageFromPosZ(self, zpos=None):
-        self.zpos = zpos
-
-        if not zpos in self.zposLUT:
-            if not self.zlim:
-                first = pydicom.dcmread(self.fDS[0], stop_before_pixels=True)
-                last = pydicom.dcmread(self.fDS[-1], stop_before_pixels=True)
-
-                zlim = [k.ImagePositionPatient[2] + self.translation[2] for k in [first,last]]        
-                deltaz = copysign(first.SliceThickness, zlim[1] - zlim[0])
+        """Load the image nearest to zpos."""
 
-                self.zlim = zlim
-                self.deltaz = deltaz
-                self.sliceThickness = first.SliceThickness
+        if zpos != None:
+            self.zpos = zpos
 
-            idx = self.findImageIndex(self.zpos)
-            
-            self.ds = pydicom.dcmread(self.fDS[idx])
-        else:
-            self.ds = pydicom.dcmread(self.zposLUT[zpos])
-            self.sliceThickness = self.ds.SliceThickness
+        self.loadSlice(self.catalog.getNearestFile(self.zpos))
+        self.sliceThickness = self.ds.SliceThickness
         
         # assert self.ds.ImagePositionPatient[2]+self.translation[2] - self.zpos <= self.sliceThickness/2
         
@@ -353,6 +565,17 @@ class Series:
         self.imageUID = self.ds.SOPInstanceUID
         self.resetImage()
 
+    def loadImageFromArray(self, image, zpos, dicomTranslation, pixelSpacing, imageUID):
+        """Use an already decoded HU image, e.g. a read-only view into a shared volume, as the loaded slice."""
+
+        self.ds = None
+        self.zpos = zpos
+        self.pixelSpacing = pixelSpacing
+        self.dicomTranslation = dicomTranslation
+        self.imageUID = imageUID
+        self.imageHU = image
+        self.resetImage()
+
     def getUIDsFromStructures(self):
         contourIdxList = list()
         imageUIDSet = set()
@@ -416,69 +639,98 @@ class Series:
         self.extStructFile.loadStructures(progress)
         self.contours = self.extStructFile.contours
         
-    def getStructuresInImageCoordinates(self):
-        X, Y = list(), list()
-        x0,y0 = [k/2 for k in np.shape(self.ds.pixel_array)]
-        ps = self.pixelSpacing
+    def getContoursInSlice(self, zpos = None):
+        """Returns the (structure, contour index, contour hash, contour) of each selected contour in the slice at zpos.
 
+            With a contourFilter (a set of contour hashes), the other contours are left out after the
+            selection of the first / last contour, e.g. to calculate only the missing results."""
+
+        if zpos == None:
+            zpos = self.zpos
+
+        contours = list()
         for structure in self.structures:
-            for contour in self.contours[structure]:
-                if abs(contour[0,2] - self.zpos) > 0.1:
+            for contourIdx, contour in enumerate(self.contours[structure]):
+                if abs(contour[0,2] - zpos) > 0.1:
                     continue
+                contours.append((structure, contourIdx, hashlib.sha1(contour.tobytes()).hexdigest(), contour))
 
-                x = (contour[:,0] - self.dicomTranslation[0] - self.translation[0]) / ps
-                y = (contour[:,1] - self.dicomTranslation[1] - self.translation[1]) / ps
-                
-                if self.dicomRotation:
-                    theta = -self.dicomRotation * 3.14159265 / 180
-                    x -= x0; y -= y0
-                    x,y = x * cos(theta) - y * sin(theta), x * sin(theta) + y * cos(theta)
-                    x += x0; y += y0
+        # Structure to choose if multiple: 0 = first, -1 = last, 1 = all
+        structureNumber = self.options and self.options.structureNumberVar.get() or 0
+        if contours and structureNumber != 1:
+            contours = [contours[structureNumber]]
 
-                x -= self.xbounds[0]
+        if self.contourFilter is not None:
+            contours = [ k for k in contours if k[2] in self.contourFilter ]
 
-                X.append(x); Y.append(y)
+        return contours
 
-        print(np.shape(X[0]))
-        if self.options.structureNumberVar.get() == 1 or len(np.shape(X)) == 2:
-            return X[0], Y[0]
-        else:
-            print("LOOP B")
-            print(np.shape(X[0][0]))
-            return X[0][self.options.structureNumberVar.get()], Y[0][self.options.structureNumberVar.get()]
+    def getHeaderFromPosZ(self, zpos):
+        """Header of the image nearest to zpos, without loading the image."""
 
-    def recalculateContourBounds(self):
-        X, Y = self.getStructuresInImageCoordinates()
+        return self.readHeader(self.catalog.getNearestFile(zpos))
 
+    def getStructuresInImageCoordinates(self, returnKeys = False):
+        """Returns the x and y image coordinates of each (selected) contour in the current slice.
 
-        if len(np.shape(X)) == 1:
-            self.xminRot = min(self.xminRot, np.min(X))
-            self.xmaxRot = max(self.xmaxRot, np.max(X))
-            self.yminRot = min(self.yminRot, np.min(Y))
-            self.ymaxRot = max(self.ymaxRot, np.max(Y))
+            With returnKeys, also returns a key per contour which identifies its mask in the current
+            image geometry (contour, z, rotation, grid, translation and reduced image size)."""
+
+        X, Y, keys = list(), list(), list()
+        x0,y0 = [k/2 for k in self.imageShape]
+        ps = self.pixelSpacing
+
+        for structure, contourIdx, contourHash, contour in self.getContoursInSlice():
+            x = (contour[:,0] - self.dicomTranslation[0] - self.translation[0]) / ps
+            y = (contour[:,1] - self.dicomTranslation[1] - self.translation[1]) / ps
+            
+            if self.dicomRotation:
+                theta = -self.dicomRotation * 3.14159265 / 180
+                x -= x0; y -= y0
+                x,y = x * cos(theta) - y * sin(theta), x * sin(theta) + y * cos(theta)
+                x += x0; y += y0
+
+            x -= self.xbounds[0]
+
+            X.append(x); Y.append(y)
+            keys.append((structure, contourIdx, contourHash))
+
+        if returnKeys:
+            geometry = (self.zpos, self.dicomRotation, tuple(self.imageShape), self.pixelSpacing,
+                        tuple(self.dicomTranslation[:2]), tuple(self.translation), self.xbounds[0], np.shape(self.image))
+            return X, Y, [ key + geometry for key in keys ]
         else:
-            for eachX in X:
-                self.xminRot = min(self.xminRot, np.min(eachX))
-                self.xmaxRot = max(self.xmaxRot, np.max(eachX))
-            for eachY in Y:
-                self.yminRot = min(self.yminRot, np.min(eachY))
-                self.ymaxRot = max(self.ymaxRot, np.max(eachY))
+            return X, Y
 
-    def convertImageToRSP(self):
-        """HU - RSP calibration
+    def recalculateContourBounds(self):
+        with stageProfile.measure("contour transform"):
+            X, Y = self.getStructuresInImageCoordinates()
 
-            Schneider et al., PMB 41(1) (1996)."""
-        
-        fHigh = lambda x: 1.06037 + 0.00046761*x
-        fLow  = lambda x: 1.02365 + 0.00100547*x
-        
-        threshold = self.image >= 200
+        for eachX in X:
+            self.xminRot = min(self.xminRot, np.min(eachX))
+            self.xmaxRot = max(self.xmaxRot, np.max(eachX))
+        for eachY in Y:
+            self.yminRot = min(self.yminRot, np.min(eachY))
+            self.ymaxRot = max(self.ymaxRot, np.max(eachY))
 
-        self.imageRSP = np.where(threshold, fHigh(self.image), 0) \
-                        + np.where(~threshold, fLow(self.image), 0)
-        
+    def convertImageToRSP(self):
+        with stageProfile.measure("RSP"):
+            self.imageRSP = convertHUToRSP(self.image, self.calibration,
+                                           out=np.empty(np.shape(self.image), dtype=self.getFloatDtype()))
         return self.imageRSP
 
+    def getImageDtype(self):
+        """Type of the (rotated) HU images: int, or the type of the loaded HU image with compactPrecision."""
+
+        if self.compactPrecision:
+            return self.imageHU.dtype
+        return np.dtype('int')
+
+    def getFloatDtype(self):
+        """Type of the RSP and WEPL images: float64, or float32 with compactPrecision."""
+
+        return self.compactPrecision and np.dtype(np.float32) or np.dtype(float)
+
     def resetImage(self, reloadImage = True):
         self.xbounds = [0,0]
         self.ybounds = [0,0]
@@ -486,28 +738,84 @@ class Series:
         self.xmaxRot = self.ymaxRot = -1e5
         self.dicomRotation = 0
         if reloadImage:
-            self.image = np.array(self.ds.pixel_array, dtype='int')
-            self.image += int(self.ds.RescaleIntercept)        
+            if self.imageHU is None:
+                self.imageHU = np.array(self.ds.pixel_array, dtype='int')
+                self.imageHU += int(self.ds.RescaleIntercept)
+            self.image = np.array(self.imageHU, dtype=self.getImageDtype())
+            self.imageShape = np.shape(self.image)
             self.imageWEPL = self.imageRSP = None
+        self.imageIsHU = reloadImage
+
+    def getSplineCoefficients(self):
+        """Spline coefficients of the loaded HU image, made once per slice and reused for all rotations."""
+
+        if self.splineCoefficients is None or self.splineCoefficients[0] is not self.imageHU:
+            with stageProfile.measure("spline prefilter"):
+                self.splineCoefficients = (self.imageHU, getSplineCoefficients(self.imageHU))
+        return self.splineCoefficients[1]
 
     def rotateImage(self,angle):
-        self.image = rotate(self.image, angle=angle, reshape=False, cval=-1000)
+        if self.imageIsHU:
+            coefficients = self.getSplineCoefficients()
+            with stageProfile.measure("rotate"):
+                self.image = rotateCoefficients(coefficients, angle, np.empty_like(self.image))
+        else:
+            with stageProfile.measure("rotate"):
+                self.image = rotate(self.image, angle=angle, reshape=False, cval=-1000)
+        self.dicomRotation = angle
+        self.imageIsHU = False
+
+    def setRotatedImage(self, image, angle):
+        """Use an image already rotated by angle, e.g. a slice of a rotated volume, as the current image."""
+
+        self.resetImage(reloadImage = False)
+        self.image = image
         self.dicomRotation = angle
+        self.imageIsHU = False
         
-    def reduceImageSize(self, pad):
-        self.xbounds = [int(self.xminRot - pad), int(self.xmaxRot + pad)]
+    def setReducedImageBounds(self, pad):
+        """Bounds of the beam corridor of the contours: from the beam entrance (the top row) to their distal
+            edge, and across their width, plus pad pixels."""
+
+        self.xbounds = [max(0, int(self.xminRot - pad)), int(self.xmaxRot + pad)]
         self.ybounds = [0,int(self.ymaxRot + pad)]
 
+    def getReducedImageWindow(self):
+        """The pixels kept by reduceImageSize, as slices of rows and columns within the image."""
+
+        return tuple(slice(*slice(*bounds).indices(n)[:2]) for bounds, n in zip([self.ybounds, self.xbounds], self.imageShape))
+
+    def reduceImageSize(self, pad):
+        self.imageIsHU = False
+        self.setReducedImageBounds(pad)
+
         self.image = self.image[self.ybounds[0]:self.ybounds[1],
                                 self.xbounds[0]:self.xbounds[1]]
 
-    def convertImageToWEPL(self):
-        shRSP = np.shape(self.imageRSP)
-        self.imageWEPL = np.zeros(shRSP)
-        for y in range(shRSP[0]):
-            self.imageWEPL[y,:] = self.imageRSP[y,:] * self.pixelSpacing
-            if y > 0: self.imageWEPL[y,:] += self.imageWEPL[y-1,:]
+    def rotateReducedImage(self, angle, pad):
+        """As rotateImage, recalculateContourBounds and reduceImageSize, but only the pixels in the beam corridor
+            of the contours are interpolated, from the spline coefficients of the slice.
+
+            The corridor is found from the rotated contours, so the work per angle grows with the
+            width and depth of the targets instead of with the size of the image."""
 
+        if not self.imageIsHU:
+            self.rotateImage(angle)
+            self.recalculateContourBounds()
+            self.reduceImageSize(pad)
+            return
+
+        self.dicomRotation = angle
+        self.recalculateContourBounds()
+        self.setReducedImageBounds(pad)
+        coefficients = self.getSplineCoefficients()
+        with stageProfile.measure("rotate"):
+            self.image = rotateCoefficients(coefficients, angle, window=self.getReducedImageWindow(), dtype=self.image.dtype)
+        self.imageIsHU = False
+
+    def convertImageToWEPL(self, out=None):
+        with stageProfile.measure("WEPL"):
+            self.imageWEPL = integrateWEPL(self.imageRSP, self.pixelSpacing, out)
         return self.imageWEPL
 
     def createWEPLcurve(self):
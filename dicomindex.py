@@ -0,0 +1,174 @@
+import numpy as np
+import pydicom, os, json, hashlib, threading
+from concurrent.futures import ThreadPoolExecutor
+from pydicom.errors import InvalidDicomError
+
+INDEX_FILE = ".weplindex.json"
+INDEX_VERSION = 2
+HEADER_TAGS = ["Modality", "ImagePositionPatient", "SOPInstanceUID", "SeriesDescription", "StudyDate", "PixelSpacing", "SliceThickness"]
+FLOAT_TAGS = ["ImagePositionPatient", "PixelSpacing", "SliceThickness"]
+CT_MODALITY = "CT"
+RTSTRUCT_MODALITY = "RTSTRUCT"
+
+class DicomHeader:
+    """The indexed tags of a DICOM file, with the same attribute access as a pydicom dataset."""
+
+    def __init__(self, tags):
+        self.__dict__.update(tags)
+
+def readHeaderTags(fileName):
+    """Read the HEADER_TAGS of a DICOM file, as JSON serializable values (None if missing).
+
+        Files which are not DICOM get None for all the tags, so that they are not read again."""
+
+    try:
+        ds = pydicom.dcmread(fileName, stop_before_pixels=True, specific_tags=HEADER_TAGS)
+    except (InvalidDicomError, EOFError):
+        return { tag : None for tag in HEADER_TAGS }
+
+    tags = dict()
+    for tag in HEADER_TAGS:
+        value = ds.get(tag)
+        if value is None or value == "":
+            tags[tag] = None
+        elif tag in FLOAT_TAGS:
+            tags[tag] = [float(k) for k in value] if np.ndim(value) else float(value)
+        else:
+            tags[tag] = str(value)
+    return tags
+
+def listFolder(folder):
+    """Returns the names of the subfolders and of the files in a folder."""
+
+    subFolders, fileNames = list(), list()
+    with os.scandir(folder) as entries:
+        for entry in entries:
+            if entry.is_dir(follow_symlinks=False):
+                subFolders.append(entry.name)
+            elif entry.is_file() and not entry.name.startswith(INDEX_FILE):
+                fileNames.append(entry.name)
+    return sorted(subFolders), sorted(fileNames)
+
+class HeaderIndex:
+    """Persistent index of the DICOM headers below a data folder.
+
+        The index is stored in the user cache folder, so that nothing is written into the data folder;
+        an INDEX_FILE in the data folder (e.g. shared with a read-only copy of the data) is read if there
+        is no index in the cache. Each entry is valid as long as the size and modification time
+        of its file are unchanged, so that only new or modified files are read again.
+
+        discoverFiles scans the data folder and reads the headers with a pool of threads, after which
+        getSeriesFiles finds the CT and RTSTRUCT files below a folder by their Modality."""
+
+    def __init__(self, folder):
+        self.dataFolder = folder
+        self.folder = os.path.abspath(folder)
+        self.entries = dict() # { relative path : [size, mtime (ns), tags] }
+        self.folderFiles = dict() # { folder : files }, from discoverFiles
+        self.headers = dict() # { file : DicomHeader }, from discoverFiles
+        self.modified = False
+        self.lock = threading.Lock()
+        self.load()
+
+    def getIndexFileName(self):
+        cacheFolder = os.path.join(os.path.expanduser("~"), ".cache", "WEPLCalculator")
+        folderHash = hashlib.sha1(self.folder.encode()).hexdigest()
+        return os.path.join(cacheFolder, f"index_{folderHash}.json")
+
+    def load(self):
+        for fileName in [ self.getIndexFileName(), os.path.join(self.folder, INDEX_FILE) ]:
+            try:
+                with open(fileName, "r") as indexFile:
+                    index = json.load(indexFile)
+            except (OSError, ValueError):
+                continue
+
+            if index.get("version") == INDEX_VERSION:
+                self.entries = index["entries"]
+                return
+
+    def save(self):
+        """Write the index if it has changed, dropping the entries of deleted files."""
+
+        if not self.modified:
+            return
+
+        self.entries = { k:v for k,v in self.entries.items() if os.path.exists(os.path.join(self.folder, k)) }
+        index = { "version" : INDEX_VERSION, "entries" : self.entries }
+
+        fileName = self.getIndexFileName()
+        try:
+            os.makedirs(os.path.dirname(fileName), exist_ok=True)
+            with open(fileName + ".tmp", "w") as indexFile:
+                json.dump(index, indexFile)
+            os.replace(fileName + ".tmp", fileName)
+        except OSError:
+            return
+
+        self.modified = False
+
+    def getHeader(self, fileName):
+        """Returns the DicomHeader of a file, reading the file only if it is not (validly) indexed."""
+
+        stat = os.stat(fileName)
+        key = os.path.relpath(os.path.abspath(fileName), self.folder)
+
+        entry = self.entries.get(key)
+        if entry and entry[0] == stat.st_size and entry[1] == stat.st_mtime_ns:
+            return DicomHeader(entry[2])
+
+        tags = readHeaderTags(fileName)
+        with self.lock:
+            self.entries[key] = [stat.st_size, stat.st_mtime_ns, tags]
+            self.modified = True
+        return DicomHeader(tags)
+
+    def discoverFiles(self, numberOfThreads=8, progress=None):
+        """Find all the files below the data folder and get their headers, using up to numberOfThreads
+            concurrent directory listings / header reads.
+
+            Returns the (sorted) folders which contain files."""
+
+        self.folderFiles = dict()
+        self.headers = dict()
+
+        with ThreadPoolExecutor(max_workers=max(1, numberOfThreads)) as executor:
+            pending = [self.dataFolder]
+            while pending:
+                listings = list(executor.map(listFolder, pending))
+                nextPending = list()
+                for folder, (subFolders, fileNames) in zip(pending, listings):
+                    if fileNames:
+                        self.folderFiles[folder] = [ os.path.join(folder, k) for k in fileNames ]
+                    nextPending += [ os.path.join(folder, k) for k in subFolders ]
+                pending = nextPending
+
+            files = [ fileName for folder in sorted(self.folderFiles) for fileName in self.folderFiles[folder] ]
+            if progress:
+                progress['maximum'] = len(files)
+                progress['value'] = 0
+
+            for fileName, header in zip(files, executor.map(self.getHeader, files)):
+                self.headers[fileName] = header
+                if progress:
+                    progress.step(1)
+                    progress.update_idletasks()
+
+        return sorted(self.folderFiles)
+
+    def getSeriesFiles(self, path):
+        """Returns the CT and the RTSTRUCT files in and below a discovered folder, as in os.walk(path)."""
+
+        ctFiles, rsFiles = list(), list()
+        for folder in sorted(self.folderFiles):
+            if folder != path and not folder.startswith(os.path.join(path, "")):
+                continue
+
+            for fileName in self.folderFiles[folder]:
+                modality = self.headers[fileName].Modality
+                if modality == CT_MODALITY:
+                    ctFiles.append(fileName)
+                elif modality == RTSTRUCT_MODALITY:
+                    rsFiles.append(fileName)
+
+        return ctFiles, rsFiles
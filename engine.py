@@ -0,0 +1,812 @@
+import numpy as np
+import os, sys, json
+import multiprocessing
+
+from classes import Series, rasterizePolygon, integrateWEPL, convertHUToRSP, rotateVolume
+from rotation import getSplineCoefficients
+from sharedvolume import SharedArray, OutputSlots, getCapacity, SLOTS_PER_CHUNK
+from raytrace import calculateSliceWEPLByRayTracing
+from cache import maskCache
+from dicomindex import HeaderIndex
+from histogram import WEPLHistogram
+from results import ResultTable, writeParquet
+from checkpoint import ResultStore
+from resultcache import ResultCache
+from calibration import loadCalibration
+from profiling import stageProfile
+
+CONFIG_FILE = "config.cfg"
+
+def readConfig(configFileName=CONFIG_FILE):
+    """Read the "key,value" lines of a config file into a dictionary. Empty values are skipped."""
+
+    config = dict()
+    if not os.path.exists(configFileName):
+        return config
+
+    with open(configFileName, "r") as configFile:
+        for line in configFile.readlines():
+            linesplit = line.rstrip().split(",")
+            if len(linesplit) < 2:
+                continue
+            var = linesplit[0]
+            value = linesplit[1]
+            if value:
+                config[var] = value
+
+    return config
+
+class Variable:
+    """Stand-in for the Tk StringVar / IntVar, so that Series can be used without a display."""
+
+    def __init__(self, value=None):
+        self.value = value
+
+    def get(self):
+        return self.value
+
+    def set(self, value):
+        if isinstance(self.value, int) and not isinstance(value, int):
+            value = int(value)
+        self.value = value
+
+class BatchOptions:
+    """The same settings as the Options of the GUI, read from config.cfg without Tk."""
+
+    def __init__(self):
+        self.registrationVector = Variable("0.7 -0.6 -4.3")
+        self.rotationEntry = Variable("list")
+        self.rotationList = Variable("0 45 90")
+        self.rotationRangeSteps = Variable(10)
+        self.dataFolderDS = Variable(".")
+        self.dataFolderRS = Variable(".")
+        self.useStructuresFromFolderTree = Variable(0)
+        self.structureNumberVar = Variable(0)
+        self.numberOfProcesses = Variable(1)
+        self.numberOfReadThreads = Variable(8)
+        self.volumeCacheFolder = Variable("")
+        self.checkpointFolder = Variable("")
+        self.resultCacheFolder = Variable("")
+        self.calibrationFile = Variable("")
+        self.compactPrecision = Variable(0)
+        self.sharedMemory = Variable(1)
+        self.volumeMode = Variable(0)
+        self.weplMethod = Variable("rotate")
+        self.histogramMode = Variable(0)
+
+        self.structureVariable = dict() # to be filled per instance
+        self.seriesVariable = dict()
+
+        self.vars = {'registrationVector' : self.registrationVector,
+                     'rotationEntry' : self.rotationEntry,
+                     'rotationList' : self.rotationList,
+                     'rotationRangeSteps' : self.rotationRangeSteps,
+                     'dataFolderDS' : self.dataFolderDS,
+                     'dataFolderRS' : self.dataFolderRS,
+                     'useStructuresFromFolderTree' : self.useStructuresFromFolderTree,
+                     'numberOfProcesses' : self.numberOfProcesses,
+                     'numberOfReadThreads' : self.numberOfReadThreads,
+                     'volumeCacheFolder' : self.volumeCacheFolder,
+                     'checkpointFolder' : self.checkpointFolder,
+                     'resultCacheFolder' : self.resultCacheFolder,
+                     'calibrationFile' : self.calibrationFile,
+                     'compactPrecision' : self.compactPrecision,
+                     'sharedMemory' : self.sharedMemory,
+                     'volumeMode' : self.volumeMode,
+                     'weplMethod' : self.weplMethod,
+                     'histogramMode' : self.histogramMode}
+
+    def loadOptions(self, configFileName=CONFIG_FILE):
+        config = readConfig(configFileName)
+        for var, value in config.items():
+            if var in self.vars:
+                self.vars[var].set(value)
+        return len(config) > 0
+
+class ConsoleProgress:
+    """Text replacement for the ttk.Progressbar, printing the percentage to a stream."""
+
+    def __init__(self, stream=sys.stderr):
+        self.stream = stream
+        self.values = {'maximum' : 100, 'value' : 0}
+        self.lastPercent = None
+
+    def __getitem__(self, key):
+        return self.values[key]
+
+    def __setitem__(self, key, value):
+        self.values[key] = value
+
+    def step(self, amount=1):
+        self.values['value'] += amount
+
+    def update_idletasks(self):
+        if not self.values['maximum']:
+            return
+        percent = int(100 * self.values['value'] / self.values['maximum'])
+        if percent != self.lastPercent:
+            self.lastPercent = percent
+            self.stream.write(f"\r{percent:3d} %")
+            if percent >= 100:
+                self.stream.write("\n")
+            self.stream.flush()
+
+def calculateSliceWEPL(s, rot, pad, method="rotate"):
+    """Rotate the loaded image of s, and find the WEPL of the pixels inside each contour.
+
+        With method "raytrace", the WEPL is instead found by ray tracing through the unrotated image,
+        see raytrace.py. Returns a list with one array of (integer) WEPL values per contour."""
+
+    if method == "raytrace":
+        return calculateSliceWEPLByRayTracing(s, rot)
+
+    s.resetImage()
+    s.rotateReducedImage(rot, pad)
+    s.convertImageToRSP()
+
+    return getContourWEPL(s, s.convertImageToWEPL())
+
+def getContourWEPL(s, wepl):
+    """Find the WEPL of the pixels inside each contour, for the (reduced) image of s and its WEPL image.
+
+        Returns a list with one array of (integer) WEPL values per contour."""
+
+    with stageProfile.measure("contour transform"):
+        X, Y, keys = s.getStructuresInImageCoordinates(returnKeys=True)
+
+    weplList = list()
+    for contourX, contourY, key in zip(X, Y, keys):
+        with stageProfile.measure("rasterize"):
+            indices = maskCache.getIndices(key, lambda: rasterizePolygon(contourX, contourY, np.shape(s.image)))
+        with stageProfile.measure("gather"):
+            weplList.append(np.array(wepl.ravel()[indices], dtype='int64'))
+
+    return weplList
+
+# State of each worker process in the parallel mode, set by initializeWorker
+workerSeries = dict()
+workerPad = 5
+workerMethod = "rotate"
+workerLoadedSlice = None
+workerVolumes = dict()
+workerSliceInfo = dict()
+workerOutput = None
+
+def initializeWorker(imageSeries, structureNumber, pad, method):
+    """Receive the (pickled) series once per worker process, see Series.__getstate__."""
+
+    global workerSeries, workerPad, workerMethod, workerLoadedSlice
+
+    options = BatchOptions()
+    options.structureNumberVar.set(structureNumber)
+    for s in imageSeries.values():
+        s.options = options
+
+    workerSeries = imageSeries
+    workerPad = pad
+    workerMethod = method
+    workerLoadedSlice = None
+
+def calculateWorkUnit(unit):
+    """Calculate the WEPL of one (series, slice, rotation) in a worker process.
+
+        Returns the study date of the slice, the WEPL values per contour and the stage times of the worker."""
+
+    global workerLoadedSlice
+
+    icIdx, zpos, rot = unit
+    s = workerSeries[icIdx]
+    if workerLoadedSlice != (icIdx, zpos):
+        s.loadImageFromPosZ(zpos)
+        workerLoadedSlice = (icIdx, zpos)
+
+    weplList = calculateSliceWEPL(s, rot, workerPad, workerMethod)
+    return s.ds.StudyDate, weplList, stageProfile.pop()
+
+def initializeSharedMemoryWorker(imageSeries, structureNumber, pad, method, volumeSpecs, sliceInfo, outputSpec):
+    """As initializeWorker, and attach to the shared HU volumes and the shared output buffer."""
+
+    global workerVolumes, workerSliceInfo, workerOutput
+
+    initializeWorker(imageSeries, structureNumber, pad, method)
+    workerVolumes = { icIdx : SharedArray.attach(spec, readOnly=True) for icIdx, spec in volumeSpecs.items() }
+    workerSliceInfo = sliceInfo
+    workerOutput = SharedArray.attach(outputSpec)
+
+def calculateSharedMemoryWorkUnit(unit):
+    """Calculate the WEPL of one (series, slice, rotation) from the shared HU volume.
+
+        The WEPL values are written to the output slot of the unit, and only the number of values per
+        contour is returned (with the stage times of the worker). If they do not fit in the slot, the
+        values are returned instead."""
+
+    global workerLoadedSlice
+
+    icIdx, sliceIdx, rot, slot = unit
+    s = workerSeries[icIdx]
+    zpos, dicomTranslation, pixelSpacing, imageUID, studyDate = workerSliceInfo[icIdx][sliceIdx]
+    if workerLoadedSlice != (icIdx, zpos):
+        s.loadImageFromArray(workerVolumes[icIdx].array[sliceIdx], zpos, dicomTranslation, pixelSpacing, imageUID)
+        workerLoadedSlice = (icIdx, zpos)
+
+    weplList = calculateSliceWEPL(s, rot, workerPad, workerMethod)
+    counts = [len(wepl) for wepl in weplList]
+    output = workerOutput.array[slot]
+    if sum(counts) > len(output):
+        return studyDate, counts, weplList, stageProfile.pop()
+
+    offset = 0
+    for wepl in weplList:
+        output[offset:offset+len(wepl)] = wepl
+        offset += len(wepl)
+
+    return studyDate, counts, None, stageProfile.pop()
+
+def getUnionWindow(windows):
+    """Smallest (rows, columns) slices containing all the non-empty windows, which all start at the top row."""
+
+    windows = [ (rows, columns) for rows, columns in windows if rows.stop > rows.start and columns.stop > columns.start ]
+    if not windows:
+        return slice(0, 0), slice(0, 0)
+
+    return (slice(0, max(rows.stop for rows, columns in windows)),
+            slice(min(columns.start for rows, columns in windows), max(columns.stop for rows, columns in windows)))
+
+class WEPLEngine:
+    """Load image series and structures, and calculate the WEPL distributions.
+
+        Used by the GUI, and without a display by batch.py. The progress object should behave
+        like a ttk.Progressbar (item access to 'maximum' / 'value', step and update_idletasks)."""
+
+    def __init__(self, options, progress=None, imagePad=5):
+        self.options = options
+        self.progress = progress
+        self.imagePad = imagePad
+        self.imageCollection = list()
+        self.reducedImageCollection = list()
+        self.extStructFile = None
+        self.structureFileName = None
+        self.structureNames = list()
+        self.calibration = loadCalibration()
+
+    def loadFolder(self, dataFolder):
+        """Make one Series per subfolder containing files, and load their image indices.
+
+            The folders are scanned and the headers read by numberOfReadThreads threads.
+            If volumeCacheFolder is set, the images of each series are read from a cached HU volume,
+            which is made when the first slice of the series is loaded."""
+
+        t = [float(k) for k in self.options.registrationVector.get().split()]
+        headerIndex = HeaderIndex(dataFolder)
+        subfolders = headerIndex.discoverFiles(int(self.options.numberOfReadThreads.get() or 1), self.progress)
+
+        self.imageCollection = [ Series(path=subFolder, translation=t, options=self.options)
+                                for subFolder in subfolders ]
+
+        if self.progress:
+            self.progress['maximum'] = len(self.imageCollection)
+            self.progress['value'] = 0
+
+        useStructuresFromFolderTree = self.options.useStructuresFromFolderTree.get()
+        for imageSeries in self.imageCollection:
+            if self.progress:
+                self.progress.step(1)
+                self.progress.update_idletasks()
+
+            imageSeries.loadImages(useStructuresFromFolderTree, headerIndex)
+            if self.options.volumeCacheFolder.get() and imageSeries.fDS:
+                imageSeries.setVolumeCache(self.options.volumeCacheFolder.get())
+
+            if useStructuresFromFolderTree and imageSeries.rs:
+                imageSeries.loadStructureNames()
+                for structureName in imageSeries.listOfStructures:
+                    if not structureName in self.structureNames:
+                        self.structureNames.append(structureName)
+
+        headerIndex.save()
+
+        if self.progress:
+            self.progress['value'] = 0
+
+    def loadStructureFile(self, fileName):
+        """Use the structures from a single RS file for all the image series."""
+
+        self.extStructFile = Series(rs=fileName, options=self.options)
+        self.structureFileName = fileName
+        self.extStructFile.loadStructureNames()
+        self.structureNames = list(self.extStructFile.listOfStructures)
+
+    def getSeriesNames(self):
+        """Returns { "SeriesDescription (StudyDate)" : number of slices } for the loaded series."""
+
+        names = dict()
+        for imageSeries in self.imageCollection:
+            for name, count in imageSeries.getAllDatesAndSeriesDescription().items():
+                if not name in names:
+                    names[name] = count
+        return names
+
+    def getRotationList(self):
+        if self.options.rotationEntry.get() == "list":
+            return [ float(k) for k in self.options.rotationList.get().split(" ") if k]
+        else:
+            return np.arange(0, 360, 360/int(self.options.rotationRangeSteps.get()))
+
+    def makeReducedImageCollection(self):
+        selectedSeries = [ k for k,v in self.options.seriesVariable.items() if v.get() ]
+        self.reducedImageCollection = list()
+        for idx, s in enumerate(self.imageCollection):
+            if any([k in selectedSeries for k in s.getAllDatesAndSeriesDescription().keys()]):
+                self.reducedImageCollection.append(idx)
+
+    def loadCheckedStructures(self):
+        structures = [ k for k,v in self.options.structureVariable.items() if v.get() ]
+
+        if self.extStructFile:
+            self.extStructFile.structures = structures
+            self.extStructFile.loadStructures()
+            for s in self.imageCollection:
+                s.contours = { k:v for k,v in self.extStructFile.contours.items() if self.options.structureVariable[k].get()}
+                s.structures = structures
+
+        else:
+            for s in self.imageCollection:
+                s.structures = structures
+                if s.rs:
+                    s.loadStructures()
+                s.contours = { k:v for k,v in s.contours.items() if self.options.structureVariable[k].get() }
+
+    def getSlicePositions(self, s):
+        """Returns the sorted z positions of the slices containing the selected structures."""
+
+        if self.extStructFile:
+            return sorted(self.extStructFile.getZposFromStructures())
+        else:
+            return sorted(s.getZposFromStructures())
+
+    def getWorkUnits(self):
+        """Returns the (image collection index, z position, rotation) of each independent calculation.
+
+            Ordered by series, slice and rotation."""
+
+        rotations = self.getRotationList()
+        units = list()
+
+        for icIdx, s in enumerate(self.imageCollection):
+            if not icIdx in self.reducedImageCollection:
+                continue
+
+            if not self.extStructFile and not s.rs:
+                print(f"No structure set found in {s.path}, skipping.")
+                continue
+
+            for zpos in self.getSlicePositions(s):
+                for rot in rotations:
+                    units.append((icIdx, zpos, rot))
+
+        return units
+
+    def calculateWorkUnits(self, units):
+        """Yields the study date and the WEPL values per contour for each work unit, in order."""
+
+        numberOfProcesses = int(self.options.numberOfProcesses.get() or 1)
+
+        method = self.options.weplMethod.get()
+
+        if self.options.volumeMode.get() and method == "rotate":
+            yield from self.calculateWorkUnitsAsVolumes(units)
+            return
+
+        if numberOfProcesses <= 1 or len(units) <= 1:
+            loadedSlice = None
+            for icIdx, zpos, rot in units:
+                s = self.imageCollection[icIdx]
+                if loadedSlice != (icIdx, zpos):
+                    s.loadImageFromPosZ(zpos)
+                    loadedSlice = (icIdx, zpos)
+
+                yield s.ds.StudyDate, calculateSliceWEPL(s, rot, self.imagePad, method)
+            return
+
+        imageSeries = { icIdx : self.imageCollection[icIdx] for icIdx in set(unit[0] for unit in units) }
+        for s in imageSeries.values():
+            s.openVolumeCache() # here, not by each worker
+        initargs = (imageSeries, self.options.structureNumberVar.get(), self.imagePad, method)
+
+        # Keep the rotations of a slice in the same chunk, so that each worker loads the slice only once
+        chunksize = max(1, min(len(self.getRotationList()), len(units) // numberOfProcesses))
+
+        # spawn also on Linux: the parent may have a Tk display connection, which should not be forked
+        context = multiprocessing.get_context("spawn")
+
+        if self.options.sharedMemory.get():
+            yield from self.calculateWorkUnitsInSharedMemory(units, context, numberOfProcesses, chunksize)
+            return
+
+        with context.Pool(numberOfProcesses, initializer=initializeWorker, initargs=initargs) as pool:
+            for studyDate, weplList, workerProfile in pool.imap(calculateWorkUnit, units, chunksize):
+                stageProfile.merge(workerProfile)
+                yield studyDate, weplList
+
+    def getRunParameters(self):
+        """The settings which determine the results of the work units, e.g. to identify a checkpoint store."""
+
+        return { 'registrationVector' : self.options.registrationVector.get(),
+                 'structures' : sorted(k for k,v in self.options.structureVariable.items() if v.get()),
+                 'structureNumber' : self.options.structureNumberVar.get(),
+                 'structureFile' : self.structureFileName and os.path.abspath(self.structureFileName),
+                 'weplMethod' : self.options.weplMethod.get(),
+                 'calibration' : self.calibration.getId(),
+                 'compactPrecision' : self.options.compactPrecision.get(),
+                 'imagePad' : self.imagePad }
+
+    def getResultCacheParameters(self):
+        """The settings, other than the image, contour and rotation, which determine the WEPL values of a contour."""
+
+        return { 'registrationVector' : [ float(k) for k in self.options.registrationVector.get().split() ],
+                 'calibration' : self.calibration.getId(),
+                 'compactPrecision' : self.options.compactPrecision.get(),
+                 'weplMethod' : self.options.weplMethod.get() }
+
+    def calculateWorkUnitsWithResultCache(self, units):
+        """As calculateWorkUnits, but the WEPL values of each (image, contour, rotation) in the result cache are reused.
+
+            Only the units with missing contours are calculated, and only for the missing contours
+            (through the contourFilter of the series); the new values are added to the cache."""
+
+        cache = ResultCache(self.options.resultCacheFolder.get())
+        parameters = self.getResultCacheParameters()
+
+        unitInfo = list()
+        todo = list()
+        contourFilters = dict() # { icIdx : hashes of the contours to calculate }
+        for icIdx, zpos, rot in units:
+            s = self.imageCollection[icIdx]
+            header = s.getHeaderFromPosZ(zpos)
+            contourHashes = [ contour[2] for contour in s.getContoursInSlice(zpos) ]
+            keys = [ cache.getKey(header.SOPInstanceUID, contourHash, rot, parameters) for contourHash in contourHashes ]
+            unitInfo.append((header.StudyDate, contourHashes, keys))
+
+            missing = { contourHash for contourHash, key in zip(contourHashes, keys) if not cache.contains(key) }
+            if missing:
+                todo.append((icIdx, zpos, rot))
+                contourFilters.setdefault(icIdx, set()).update(missing)
+
+        for icIdx, contourFilter in contourFilters.items():
+            self.imageCollection[icIdx].contourFilter = contourFilter
+
+        try:
+            todoSet = set(todo)
+            calculated = self.calculateWorkUnits(todo)
+            for unit, (studyDate, contourHashes, keys) in zip(units, unitInfo):
+                if not unit in todoSet:
+                    yield studyDate, [ cache.read(key) for key in keys ]
+                    continue
+
+                studyDate, calculatedList = next(calculated)
+                contourFilter = contourFilters[unit[0]]
+                weplOfContour = dict(zip([ k for k in contourHashes if k in contourFilter ], calculatedList))
+                weplList = list()
+                for contourHash, key in zip(contourHashes, keys):
+                    if contourHash in weplOfContour:
+                        cache.write(key, weplOfContour[contourHash])
+                        weplList.append(weplOfContour[contourHash])
+                    else:
+                        weplList.append(cache.read(key))
+                yield studyDate, weplList
+
+        finally:
+            for icIdx in contourFilters:
+                self.imageCollection[icIdx].contourFilter = None
+
+    def calculateWorkUnitsWithCheckpoints(self, units, calculate):
+        """As calculate(units), but the units found in the checkpoint store are read instead of calculated,
+            and each calculated unit is saved to the store as soon as it is done."""
+
+        store = ResultStore(self.options.checkpointFolder.get(), self.getRunParameters())
+        getPartition = lambda unit: (self.imageCollection[unit[0]].path, unit[1], unit[2])
+
+        todo = [ unit for unit in units if not store.contains(*getPartition(unit)) ]
+        if len(todo) < len(units):
+            print(f"Continuing from {store.folder}: {len(units) - len(todo)} of {len(units)} work units done.")
+
+        todoSet = set(todo)
+        calculated = calculate(todo)
+        for unit in units:
+            if unit in todoSet:
+                studyDate, weplList = next(calculated)
+                store.write(*getPartition(unit), studyDate, weplList)
+                yield studyDate, weplList
+            else:
+                yield store.read(*getPartition(unit))
+
+    def getSlicePositionsOfUnits(self, units):
+        """Returns { image collection index : z positions } of the work units, in order."""
+
+        zposLists = dict()
+        for icIdx, zpos, rot in units:
+            zposLists.setdefault(icIdx, list())
+            if not zpos in zposLists[icIdx]:
+                zposLists[icIdx].append(zpos)
+
+        return zposLists
+
+    def loadVolume(self, icIdx, zposList, shared=False):
+        """Load the slices of a series into one HU volume of shape (slices, rows, columns).
+
+            The volume is an int array, or a SharedArray of the smallest integer type if shared.
+            Returns the volume, the (zpos, dicomTranslation, pixelSpacing, imageUID, studyDate) of each slice,
+            and the capacity (maximum number of structure pixels under any rotation) of each slice."""
+
+        s = self.imageCollection[icIdx]
+        volume = array = None
+        sliceInfo = list()
+        capacities = list()
+
+        for sliceIdx, zpos in enumerate(zposList):
+            s.loadImageFromPosZ(zpos)
+            if volume is None:
+                shape = (len(zposList),) + np.shape(s.imageHU)
+                if shared:
+                    volume = SharedArray(shape, s.getVolumeDtype())
+                    array = volume.array
+                else:
+                    volume = array = np.empty(shape, dtype=s.getImageDtype())
+            elif np.shape(s.imageHU) != array.shape[1:]:
+                if shared:
+                    volume.close()
+                raise ValueError(f"The images in {s.path} have different sizes, cannot make a volume.")
+
+            array[sliceIdx] = s.imageHU
+            sliceInfo.append((s.zpos, s.dicomTranslation, s.pixelSpacing, s.imageUID, s.ds.StudyDate))
+            capacities.append(getCapacity(s.getStructuresInImageCoordinates()))
+
+        return volume, sliceInfo, capacities
+
+    def calculateWorkUnitsInSharedMemory(self, units, context, numberOfProcesses, chunksize):
+        """Parallel calculation where each series is loaded once into shared memory.
+
+            The workers attach to the HU volumes as read-only views, and write the WEPL values into a
+            fixed number of shared output slots, each holding the largest unit (see getCapacity). A unit
+            is only submitted when a slot is free, and its slot is released once its values are copied.
+            Only small tuples are pickled per unit, so the memory use and transport time do not grow with
+            the number of processes, and the output buffer does not grow with the number of units."""
+
+        zposLists = self.getSlicePositionsOfUnits(units)
+
+        volumes = dict()
+        slots = None
+
+        try:
+            sliceInfo = dict()
+            capacities = dict()
+            for icIdx, zposList in zposLists.items():
+                volumes[icIdx], sliceInfo[icIdx], capacities[icIdx] = self.loadVolume(icIdx, zposList, shared=True)
+
+            sliceIndices = { icIdx : { zpos : sliceIdx for sliceIdx, zpos in enumerate(zposList) } for icIdx, zposList in zposLists.items() }
+            sharedUnits = [ (icIdx, sliceIndices[icIdx][zpos], rot) for icIdx, zpos, rot in units ]
+
+            slotSize = max(max(capacity) for capacity in capacities.values())
+            slots = OutputSlots(numberOfProcesses * chunksize * SLOTS_PER_CHUNK, slotSize)
+
+            imageSeries = { icIdx : self.imageCollection[icIdx] for icIdx in zposLists }
+            volumeSpecs = { icIdx : volume.getSpec() for icIdx, volume in volumes.items() }
+            initargs = (imageSeries, self.options.structureNumberVar.get(), self.imagePad, self.options.weplMethod.get(),
+                        volumeSpecs, sliceInfo, slots.output.getSpec())
+
+            with context.Pool(numberOfProcesses, initializer=initializeSharedMemoryWorker, initargs=initargs) as pool:
+                try:
+                    slotUnits = slots.feed(sharedUnits)
+                    results = pool.imap(calculateSharedMemoryWorkUnit, slotUnits, chunksize)
+                    for studyDate, counts, weplList, workerProfile in results:
+                        stageProfile.merge(workerProfile)
+                        slot = slots.popSlot()
+                        if weplList is None:
+                            weplList = list()
+                            output = slots.output.array[slot]
+                            offset = 0
+                            for count in counts:
+                                weplList.append(np.array(output[offset:offset+count], dtype='int64'))
+                                offset += count
+                            del output
+                        slots.release(slot)
+
+                        yield studyDate, weplList
+                finally:
+                    slots.stop() # before the pool is terminated
+
+        finally:
+            for volume in volumes.values():
+                volume.close()
+            if slots:
+                slots.close()
+
+    def calculateWorkUnitsAsVolumes(self, units):
+        """Calculation where the slices of each series are rotated together, once per rotation.
+
+            Only the beam corridors of the slices (their union across the volume) are rotated, and the
+            RSP conversion and the WEPL integration are done on this part of the rotated volume; the
+            reduced image of each slice is a view into it. The results are identical to the per-slice
+            calculation, and are yielded in the same order. Needs four volumes of memory (HU, spline
+            coefficients, rotated HU and WEPL) for one series at a time."""
+
+        unitsPerSeries = dict()
+        for unit in units:
+            unitsPerSeries.setdefault(unit[0], list()).append(unit)
+
+        for icIdx, zposList in self.getSlicePositionsOfUnits(units).items():
+            s = self.imageCollection[icIdx]
+            volume, sliceInfo, capacities = self.loadVolume(icIdx, zposList)
+            with stageProfile.measure("spline prefilter"):
+                coefficients = getSplineCoefficients(volume)
+            rotatedBuffer = np.empty(volume.size, dtype=volume.dtype)
+            weplBuffer = np.empty(volume.size, dtype=s.getFloatDtype())
+            pixelSpacing = [ info[2] for info in sliceInfo ]
+
+            results = dict()
+            for rot in dict.fromkeys(unit[2] for unit in unitsPerSeries[icIdx]):
+                windows = list()
+                for sliceIdx, (zpos, dicomTranslation, thisPixelSpacing, imageUID, studyDate) in enumerate(sliceInfo):
+                    s.loadImageFromArray(volume[sliceIdx], zpos, dicomTranslation, thisPixelSpacing, imageUID)
+                    s.dicomRotation = rot
+                    s.recalculateContourBounds()
+                    s.setReducedImageBounds(self.imagePad)
+                    windows.append(s.getReducedImageWindow())
+
+                rows, columns = getUnionWindow(windows)
+                shape = (len(sliceInfo), rows.stop - rows.start, columns.stop - columns.start)
+                rotatedVolume = rotatedBuffer[:np.prod(shape)].reshape(shape)
+                weplVolume = weplBuffer[:np.prod(shape)].reshape(shape)
+
+                with stageProfile.measure("rotate"):
+                    rotateVolume(volume, rot, out=rotatedVolume, coefficients=coefficients, window=(rows, columns))
+                with stageProfile.measure("RSP"):
+                    convertHUToRSP(rotatedVolume, self.calibration, out=weplVolume)
+                with stageProfile.measure("WEPL"):
+                    integrateWEPL(weplVolume, pixelSpacing, out=weplVolume)
+
+                for sliceIdx, (zpos, dicomTranslation, thisPixelSpacing, imageUID, studyDate) in enumerate(sliceInfo):
+                    sliceRows, sliceColumns = windows[sliceIdx]
+                    if sliceRows.stop > sliceRows.start and sliceColumns.stop > sliceColumns.start:
+                        reduced = (sliceIdx, slice(sliceRows.start - rows.start, sliceRows.stop - rows.start),
+                                   slice(sliceColumns.start - columns.start, sliceColumns.stop - columns.start))
+                    else:
+                        reduced = (sliceIdx, slice(0, 0), slice(0, 0))
+
+                    s.loadImageFromArray(volume[sliceIdx], zpos, dicomTranslation, thisPixelSpacing, imageUID)
+                    s.setRotatedImage(rotatedVolume[reduced], rot)
+                    s.recalculateContourBounds()
+                    s.setReducedImageBounds(self.imagePad)
+
+                    results[(zpos, rot)] = studyDate, getContourWEPL(s, weplVolume[reduced])
+
+            for unit in unitsPerSeries[icIdx]:
+                yield results.pop(unit[1:])
+
+    def calculateResults(self):
+        """Calculate the WEPL of each structure pixel for all selected series, slices and rotations.
+
+            The work is spread over numberOfProcesses worker processes if more than one.
+            Yields the study date, 4D phase, structure index, rotation and WEPL values per structure and work unit.
+            The time of each stage is collected in profiling.stageProfile, from the start of the run."""
+
+        stageProfile.reset()
+        self.makeReducedImageCollection()
+        with stageProfile.measure("load structures"):
+            self.loadCheckedStructures()
+
+        self.calibration = loadCalibration(self.options.calibrationFile.get())
+        for s in self.imageCollection:
+            s.calibration = self.calibration
+            s.compactPrecision = bool(self.options.compactPrecision.get())
+
+        units = self.getWorkUnits()
+
+        if self.progress:
+            self.progress['maximum'] = len(units)
+            self.progress['value'] = 0
+
+        calculate = self.calculateWorkUnits
+        if self.options.resultCacheFolder.get():
+            calculate = self.calculateWorkUnitsWithResultCache
+
+        if self.options.checkpointFolder.get():
+            results = self.calculateWorkUnitsWithCheckpoints(units, calculate)
+        else:
+            results = calculate(units)
+
+        for (icIdx, zpos, rot), (studyDate, weplList) in zip(units, results):
+            if self.progress:
+                self.progress.step(1)
+                self.progress.update_idletasks()
+
+            stageProfile.count("work units")
+            amplitude = self.imageCollection[icIdx].amplitude
+            for idx, weplImageBinned in enumerate(weplList):
+                stageProfile.count("structure pixels", len(weplImageBinned))
+                yield studyDate, amplitude, idx, rot, weplImageBinned
+
+        if self.progress:
+            self.progress['value'] = 0
+
+    def makeDataFrame(self):
+        """Returns a data frame with one row per structure pixel and rotation, and the study date of the first image.
+
+            The 4D phase and rotation columns are categorical."""
+
+        results = ResultTable()
+        thisDate = None
+
+        for studyDate, amplitude, idx, rot, weplImageBinned in self.calculateResults():
+            thisDate = thisDate or studyDate
+            with stageProfile.measure("aggregate"):
+                results.add(amplitude, idx, rot, weplImageBinned)
+
+        with stageProfile.measure("aggregate"):
+            dfSum = results.toDataFrame()
+        return dfSum, thisDate
+
+    def makeHistograms(self):
+        """Returns the WEPL histograms per 4D phase, structure and rotation, and the study date of the first image.
+
+            The memory use depends on the WEPL range, not on the number of pixels."""
+
+        histograms = WEPLHistogram()
+        thisDate = None
+
+        for studyDate, amplitude, idx, rot, weplImageBinned in self.calculateResults():
+            thisDate = thisDate or studyDate
+            with stageProfile.measure("aggregate"):
+                histograms.add(amplitude, idx, rot, weplImageBinned)
+
+        return histograms, thisDate
+
+    def writeHistogramResults(self, histograms, thisDate, outputFolder="output"):
+        """Save the WEPL histograms, and their quartiles per 4D phase and rotation, as CSV files.
+
+            Returns the file names."""
+
+        if not os.path.exists(outputFolder):
+            os.makedirs(outputFolder)
+
+        fileName = os.path.join(outputFolder, f"WEPL_{thisDate}_histograms.csv")
+        histograms.toDataFrame().to_csv(fileName, index=False)
+
+        quantileFileName = os.path.join(outputFolder, f"WEPL_{thisDate}_quartiles.csv")
+        histograms.getQuantileTable().to_csv(quantileFileName)
+
+        return fileName, quantileFileName, self.writeSettings(thisDate, outputFolder)
+
+    def writeSettings(self, thisDate, outputFolder="output"):
+        """Save the run parameters, including the HU - RSP calibration curve, next to the results."""
+
+        settings = self.getRunParameters()
+        settings['calibrationSegments'] = [ list(k) for k in self.calibration.segments ]
+        settings['rotations'] = [ float(k) for k in self.getRotationList() ]
+
+        fileName = os.path.join(outputFolder, f"WEPL_{thisDate}_settings.json")
+        with open(fileName, "w") as settingsFile:
+            json.dump(settings, settingsFile, indent=1)
+        return fileName
+
+    def writeResults(self, dfSum, thisDate, outputFolder="output", parquet=False):
+        """Save the WEPL table, and its quartiles per 4D phase and rotation, as CSV files.
+
+            With parquet, the table is saved as a Parquet dataset partitioned per 4D phase and rotation instead.
+            Returns the file names."""
+
+        if not os.path.exists(outputFolder):
+            os.makedirs(outputFolder)
+
+        if parquet:
+            fileName = os.path.join(outputFolder, f"WEPL_{thisDate}.parquet")
+            writeParquet(dfSum, fileName)
+        else:
+            fileName = os.path.join(outputFolder, f"WEPL_{thisDate}.csv")
+            dfSum.to_csv(fileName, index=False)
+
+        quantileFileName = os.path.join(outputFolder, f"WEPL_{thisDate}_quartiles.csv")
+        quantiles = dfSum.groupby(['4D phase', 'rotation'], observed=True)['WEPL'].quantile([0.25, 0.5, 0.75]).unstack()
+        quantiles.to_csv(quantileFileName)
+
+        return fileName, quantileFileName, self.writeSettings(thisDate, outputFolder)
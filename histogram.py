@@ -0,0 +1,95 @@
+import numpy as np
+import pandas as pd
+
+HISTOGRAM_BIN_WIDTH = 1 # mm, the WEPL values are truncated to integers
+
+class WEPLHistogram:
+    """Streaming WEPL histograms per (4D phase, structure index, rotation), instead of one row per pixel.
+
+        The bins have a fixed width and start at 0; the number of bins grows with the largest WEPL,
+        so that the memory is independent of the number of pixels. The quantiles are found from the
+        cumulative histogram in the same way as pandas (linear interpolation between the order
+        statistics); with the default bin width of 1 mm they are identical to the quantiles of the
+        integer WEPL values."""
+
+    def __init__(self, binWidth=HISTOGRAM_BIN_WIDTH):
+        self.binWidth = binWidth
+        self.counts = dict() # { (4D phase, structure index, rotation) : counts per bin }
+
+    def __len__(self):
+        return len(self.counts)
+
+    def add(self, phase, structureIdx, rotation, wepl):
+        """Add the WEPL values [mm] of the pixels of one structure in one slice."""
+
+        bins = np.maximum(np.asarray(wepl) // self.binWidth, 0).astype(np.int64)
+        self.addCounts((phase, structureIdx, rotation), np.bincount(bins))
+
+    def addCounts(self, key, counts):
+        current = self.counts.get(key)
+        if current is None:
+            self.counts[key] = np.array(counts, dtype=np.int64)
+            return
+
+        if len(counts) > len(current):
+            current = np.pad(current, (0, len(counts) - len(current)))
+            self.counts[key] = current
+        current[:len(counts)] += counts
+
+    def getCounts(self, keyFilter=None):
+        """Sum of the histograms of the keys for which keyFilter(key) is true (default: all)."""
+
+        total = WEPLHistogram(self.binWidth)
+        for key, counts in self.counts.items():
+            if keyFilter is None or keyFilter(key):
+                total.addCounts(None, counts)
+        return total.counts.get(None, np.zeros(0, dtype=np.int64))
+
+    def getQuantiles(self, counts, q=(0.25, 0.5, 0.75)):
+        """Quantiles of a histogram (counts per bin), as the lower edges of the bins."""
+
+        cumulative = np.cumsum(counts)
+        n = cumulative[-1] if len(cumulative) else 0
+        if not n:
+            return np.full(len(q), np.nan)
+
+        position = (n - 1) * np.asarray(q, dtype=float)
+        lower = np.floor(position)
+        lowerValue = np.searchsorted(cumulative, lower, side='right')
+        upperValue = np.searchsorted(cumulative, np.minimum(lower + 1, n - 1), side='right')
+        return (lowerValue + (position - lower) * (upperValue - lowerValue)) * self.binWidth
+
+    def getQuantileTable(self, q=(0.25, 0.5, 0.75)):
+        """Quantiles per 4D phase and rotation (all structures together), as the quartiles of writeResults."""
+
+        groups = sorted({ (phase, rotation) for phase, structureIdx, rotation in self.counts })
+        rows = [ self.getQuantiles(self.getCounts(lambda key: (key[0], key[2]) == group), q) for group in groups ]
+        index = pd.MultiIndex.from_tuples(groups, names=['4D phase', 'rotation'])
+        return pd.DataFrame(rows, index=index, columns=list(q))
+
+    def getViolinStats(self, keyFilter=None):
+        """Statistics of the summed histograms of the keys for Axes.violin, e.g. for a violin plot without the pixel values."""
+
+        counts = self.getCounts(keyFilter)
+        n = np.sum(counts)
+        if not n:
+            return None
+
+        coords = np.arange(len(counts)) * self.binWidth
+        nonzero = np.flatnonzero(counts)
+        return { 'coords' : coords, 'vals' : counts / n / self.binWidth, 'mean' : np.sum(coords * counts) / n,
+                 'median' : self.getQuantiles(counts, [0.5])[0],
+                 'min' : coords[nonzero[0]], 'max' : coords[nonzero[-1]] }
+
+    def toDataFrame(self):
+        """The non-empty bins as a table with the lower bin edge [mm] and the number of pixels."""
+
+        dfList = list()
+        for (phase, structureIdx, rotation), counts in self.counts.items():
+            bins = np.flatnonzero(counts)
+            dfList.append(pd.DataFrame({'4D phase':phase, 'structureIdx':structureIdx, 'rotation':rotation,
+                                        'WEPL':bins * self.binWidth, 'count':counts[bins]}))
+
+        if not dfList:
+            return pd.DataFrame(columns=['4D phase', 'structureIdx', 'rotation', 'WEPL', 'count'])
+        return pd.concat(dfList, ignore_index=True)
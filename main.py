@@ -24,6 +24,8 @@ except:
     import tkFileDialog as filedialog
 
 from classes import *
+from engine import WEPLEngine, readConfig
+from profiling import stageProfile
 
 Gy = 1
 dGy = 0.1
@@ -190,6 +192,17 @@ class Options():
         self.dataFolderRS = StringVar(value=".")
         self.useStructuresFromFolderTree = IntVar(value=0)
         self.structureNumberVar = IntVar(value=0)
+        self.numberOfProcesses = IntVar(value=1)
+        self.numberOfReadThreads = IntVar(value=8)
+        self.volumeCacheFolder = StringVar(value="")
+        self.checkpointFolder = StringVar(value="")
+        self.resultCacheFolder = StringVar(value="")
+        self.calibrationFile = StringVar(value="")
+        self.compactPrecision = IntVar(value=0)
+        self.sharedMemory = IntVar(value=1)
+        self.volumeMode = IntVar(value=0)
+        self.weplMethod = StringVar(value="rotate")
+        self.histogramMode = IntVar(value=0)
         
         self.structureVariable = dict() # to be filled per instance
         self.seriesVariable = dict()
@@ -200,21 +213,25 @@ class Options():
                      'rotationRangeSteps' : self.rotationRangeSteps,
                      'dataFolderDS' : self.dataFolderDS,
                      'dataFolderRS' : self.dataFolderRS,
-                     'useStructuresFromFolderTree' : self.useStructuresFromFolderTree}
+                     'useStructuresFromFolderTree' : self.useStructuresFromFolderTree,
+                     'numberOfProcesses' : self.numberOfProcesses,
+                     'numberOfReadThreads' : self.numberOfReadThreads,
+                     'volumeCacheFolder' : self.volumeCacheFolder,
+                     'checkpointFolder' : self.checkpointFolder,
+                     'resultCacheFolder' : self.resultCacheFolder,
+                     'calibrationFile' : self.calibrationFile,
+                     'compactPrecision' : self.compactPrecision,
+                     'sharedMemory' : self.sharedMemory,
+                     'volumeMode' : self.volumeMode,
+                     'weplMethod' : self.weplMethod,
+                     'histogramMode' : self.histogramMode}
 
     def loadOptions(self):
-        read = False
-        if os.path.exists('config.cfg'):
-            with open("config.cfg", "r") as configFile:
-                for line in configFile.readlines():
-                    linesplit = line.rstrip().split(",")
-                    var = linesplit[0]
-                    value = linesplit[1]
-                    if value:
-                        read = True
-                        if var in list(self.vars.keys()): 
-                            self.vars[var].set(value)
-        return read
+        config = readConfig("config.cfg")
+        for var, value in config.items():
+            if var in list(self.vars.keys()): 
+                self.vars[var].set(value)
+        return len(config) > 0
 
     def saveOptions(self):
         with open("config.cfg","w") as configFile:
@@ -280,6 +297,13 @@ class MainMenu(Frame):
         self.rotationListContainer = Frame(self.middleLeftLowerContainer)
         self.rotationRangeContainer = Frame(self.middleLeftLowerContainer)
         self.structureNumberContainer = Frame(self.middleLeftLowerContainer)
+        self.numberOfProcessesContainer = Frame(self.middleLeftLowerContainer)
+        self.volumeModeContainer = Frame(self.middleLeftLowerContainer)
+        self.volumeCacheContainer = Frame(self.middleLeftLowerContainer)
+        self.weplMethodContainer = Frame(self.middleLeftLowerContainer)
+        self.histogramModeContainer = Frame(self.middleLeftLowerContainer)
+        self.calibrationContainer = Frame(self.middleLeftLowerContainer)
+        self.compactPrecisionContainer = Frame(self.middleLeftLowerContainer)
         self.structureActionContainer = Frame(self.middleRightMiddleContainer)
         self.seriesActionContainer = Frame(self.middleRightLowerContainer)
 
@@ -361,9 +385,53 @@ class MainMenu(Frame):
             Radiobutton(self.structureNumberContainer, text=text, value=mode,
                         variable=self.options.structureNumberVar).pack(side=LEFT, anchor=W)
 
+        self.numberOfProcessesContainer.pack(anchor=W)
+        Label(self.numberOfProcessesContainer, text="Number of parallel processes: ").pack(side=LEFT, anchor=W)
+        Entry(self.numberOfProcessesContainer, textvariable=self.options.numberOfProcesses, width=5).pack(side=LEFT)
+        Label(self.numberOfProcessesContainer, text=" file reading threads: ").pack(side=LEFT, anchor=W)
+        Entry(self.numberOfProcessesContainer, textvariable=self.options.numberOfReadThreads, width=5).pack(side=LEFT)
+
+        self.volumeCacheContainer.pack(anchor=W)
+        Label(self.volumeCacheContainer, text="Volume cache folder (empty = off): ").pack(side=LEFT, anchor=W)
+        Entry(self.volumeCacheContainer, textvariable=self.options.volumeCacheFolder, width=25).pack(side=LEFT)
+        Label(self.volumeCacheContainer, text=" checkpoint folder: ").pack(side=LEFT, anchor=W)
+        Entry(self.volumeCacheContainer, textvariable=self.options.checkpointFolder, width=25).pack(side=LEFT)
+        Label(self.volumeCacheContainer, text=" result cache folder: ").pack(side=LEFT, anchor=W)
+        Entry(self.volumeCacheContainer, textvariable=self.options.resultCacheFolder, width=25).pack(side=LEFT)
+
+        self.volumeModeContainer.pack(anchor=W)
+        Label(self.volumeModeContainer, text="Rotate slices as one volume: ").pack(side=LEFT, anchor=W)
+        for text, mode in [["Yes", 1], ["No", 0]]:
+            Radiobutton(self.volumeModeContainer, text=text, variable=self.options.volumeMode,
+                        value=mode).pack(side=LEFT)
+
+        self.weplMethodContainer.pack(anchor=W)
+        Label(self.weplMethodContainer, text="WEPL calculation: ").pack(side=LEFT, anchor=W)
+        for text, mode in [["Rotate image", "rotate"], ["Ray tracing", "raytrace"]]:
+            Radiobutton(self.weplMethodContainer, text=text, variable=self.options.weplMethod,
+                        value=mode).pack(side=LEFT)
+
+        self.calibrationContainer.pack(anchor=W)
+        Label(self.calibrationContainer, text="HU-RSP calibration file (empty = Schneider): ").pack(side=LEFT, anchor=W)
+        Entry(self.calibrationContainer, textvariable=self.options.calibrationFile, width=25).pack(side=LEFT)
+
+        self.compactPrecisionContainer.pack(anchor=W)
+        Label(self.compactPrecisionContainer, text="Precision: ").pack(side=LEFT, anchor=W)
+        for text, mode in [["Double (float64)", 0], ["Compact (int16 / float32)", 1]]:
+            Radiobutton(self.compactPrecisionContainer, text=text, variable=self.options.compactPrecision,
+                        value=mode).pack(side=LEFT)
+
+        self.histogramModeContainer.pack(anchor=W)
+        Label(self.histogramModeContainer, text="Keep WEPL of: ").pack(side=LEFT, anchor=W)
+        for text, mode in [["All pixels", 0], ["Histograms only", 1]]:
+            Radiobutton(self.histogramModeContainer, text=text, variable=self.options.histogramMode,
+                        value=mode).pack(side=LEFT)
+
         self.progress = ttk.Progressbar(self.middleRightUpperContainer, orient=HORIZONTAL, maximum=100, mode='determinate')
         self.progress.pack(fill=X, pady=3)
 
+        self.engine = WEPLEngine(self.options, self.progress, self.imagePad)
+
         Label(self.middleRightMiddleContainer, text='STRUCTURES', font=('Helvetica',10)).pack(anchor=N)
         
         self.structureActionContainer.pack(anchor=N)
@@ -455,14 +523,8 @@ class MainMenu(Frame):
 
         self.options.dataFolderDS.set(dataFolder)
 
-        t = [float(k) for k in self.options.registrationVector.get().split(" ")]
-        subfolders = [ root for root, dirs, files in os.walk(dataFolder) if len(files) ]
-
-        self.imageCollection = [ Series(path=os.path.join(dataFolder, subFolder), translation=t, options=self.options)
-                                for subFolder in subfolders ]
-
-        self.progress['maximum'] = len(self.imageCollection)
-        self.progress['value'] = 0
+        self.engine.loadFolder(dataFolder)
+        self.imageCollection = self.engine.imageCollection
         
         seriesContainer = [self.middleRightLower1Container,
                            self.middleRightLower2Container,
@@ -474,48 +536,36 @@ class MainMenu(Frame):
                               self.middleRightMiddle3Container,
                               self.middleRightMiddle4Container]
 
-        loaded_rs = False
         idx_struct = 0
         idx_names = 0
 
-        for imageSeries in self.imageCollection:
-            self.progress.step(1)
-            self.progress.update_idletasks()
-
-            load_rs = self.options.useStructuresFromFolderTree.get() and not loaded_rs
-            imageSeries.loadImages(load_rs)
-
-            if self.options.useStructuresFromFolderTree.get():
-                # Load Structures onto Container for selection
-                if imageSeries.rs and not loaded_rs:
-                    self.progress['maximum'] = len(self.imageCollection) + len(imageSeries.rs.ROIContourSequence)
-                    imageSeries.loadStructures(progress)
-                    for structureName in imageSeries.listOfStructures:
-                        if structureName in self.options.structureVariable.keys():
-                            continue
-                        
-                        self.options.structureVariable[structureName] = IntVar(value=0)
-                        self.structureCheckbutton[structureName] = Checkbutton(structureContainer[idx_struct%4], text=structureName,
-                                                                        variable=self.options.structureVariable[structureName])
-                        self.structureCheckbutton[structureName].pack(anchor=NW)
-                        idx_struct += 1
-                        
-                    loaded_rs = True
-                    self.structureActionCheckAllButton['state'] = 'normal'
-                    self.structureActionUncheckAllButton['state'] = 'normal'
-
-            # Load Series onto Container for selection
-            for name, count in imageSeries.getAllDatesAndSeriesDescription().items():
-                if name in self.options.seriesVariable.keys():
+        if self.options.useStructuresFromFolderTree.get() and self.engine.structureNames:
+            # Load Structures onto Container for selection
+            for structureName in self.engine.structureNames:
+                if structureName in self.options.structureVariable.keys():
                     continue
 
-                newName = f"{name[:-1]}, {count} slices)"
+                self.options.structureVariable[structureName] = IntVar(value=0)
+                self.structureCheckbutton[structureName] = Checkbutton(structureContainer[idx_struct%4], text=structureName,
+                                                                variable=self.options.structureVariable[structureName])
+                self.structureCheckbutton[structureName].pack(anchor=NW)
+                idx_struct += 1
+
+            self.structureActionCheckAllButton['state'] = 'normal'
+            self.structureActionUncheckAllButton['state'] = 'normal'
+
+        # Load Series onto Container for selection
+        for name, count in self.engine.getSeriesNames().items():
+            if name in self.options.seriesVariable.keys():
+                continue
+
+            newName = f"{name[:-1]}, {count} slices)"
 
-                self.options.seriesVariable[name] = IntVar(value=1)
-                self.seriesCheckbutton[name] = Checkbutton(seriesContainer[idx_names%4], text=newName,
-                                                           variable=self.options.seriesVariable[name])
-                self.seriesCheckbutton[name].pack(anchor=NW)
-                idx_names += 1
+            self.options.seriesVariable[name] = IntVar(value=1)
+            self.seriesCheckbutton[name] = Checkbutton(seriesContainer[idx_names%4], text=newName,
+                                                       variable=self.options.seriesVariable[name])
+            self.seriesCheckbutton[name].pack(anchor=NW)
+            idx_names += 1
 
         # Activate buttons
         self.seriesActionCheckAllButton['state'] = 'normal'
@@ -536,11 +586,8 @@ class MainMenu(Frame):
         self.options.dataFolderRS.set("/".join(fileName.split("/")[:-1]) + "/")
         
         try:
-            self.extStructFile = Series(rs=fileName, options=self.options)
-            
-            self.progress['maximum'] = len(self.extStructFile.rs.ROIContourSequence)
-            self.extStructFile.loadStructureNames(self.progress)
-            self.progress['value'] = 0
+            self.engine.loadStructureFile(fileName)
+            self.extStructFile = self.engine.extStructFile
             
             structureContainer = [self.middleRightMiddle1Container,
                                   self.middleRightMiddle2Container,
@@ -581,89 +628,32 @@ class MainMenu(Frame):
             check.set(0)
 
     def getRotationList(self):
-        if self.options.rotationEntry.get() == "list":
-            return [ float(k) for k in self.options.rotationList.get().split(" ") if k]
-        else:
-            return np.arange(0, 360, 360/int(self.options.rotationRangeSteps.get()))
+        return self.engine.getRotationList()
 
     def makeReducedImageCollection(self):       
-        selectedSeries = [ k for k,v in self.options.seriesVariable.items() if v.get() ]
-        self.reducedImageCollection = list()
-        for idx, s in enumerate(self.imageCollection):
-            if any([k in selectedSeries for k in s.getAllDatesAndSeriesDescription().keys()]):
-                self.reducedImageCollection.append(idx)
+        self.engine.makeReducedImageCollection()
+        self.reducedImageCollection = self.engine.reducedImageCollection
 
     def loadCheckedStructures(self):
-        structures = [ k for k,v in self.options.structureVariable.items() if v.get() ]
-                
-        if self.extStructFile:
-            for s in self.imageCollection:
-                self.extStructFile.structures = structures
-                self.extStructFile.loadStructures()
-                s.contours = { k:v for k,v in self.extStructFile.contours.items() if self.options.structureVariable[k].get()}
-                s.structures = structures                
-                
-        else:
-            for s in self.imageCollection:
-                s.contours = { k:v for k,v in s.contours.items() if self.options.structureVariable[k].get() }
-                s.structures = structures
+        self.engine.loadCheckedStructures()
 
     def makeDataFrame(self):
-        self.makeReducedImageCollection()
-        self.loadCheckedStructures()
-
-        rotations = self.getRotationList()
-        dfSum = pd.DataFrame()
-
-        thisDate = None
-
-        for icIdx, s in enumerate(self.imageCollection):
-            if not icIdx in self.reducedImageCollection:
-                continue
-            
-            if self.extStructFile:
-                UIDs = self.extStructFile.getUIDsFromStructures()
-                zposList = sorted(self.extStructFile.getZposFromStructures())
-            else:
-                UIDs = s.getUIDsFromStructures()
-                zposList = sorted(s.getZposFromStructures()) # NEW
-
-            self.progress['maximum'] = len(self.reducedImageCollection) * (len(zposList)) * len(rotations)
-
-            for idxUID, UID in enumerate(list(UIDs)):
-                s.loadImageFromPosZ(zposList[idxUID])
-
-                if not thisDate:
-                    thisDate = s.ds.StudyDate
-
-                for rot in rotations:
-                    self.progress.step(1)
-                    self.progress.update_idletasks()
-
-                    s.resetImage()
-                    s.rotateImage(rot)
-                    s.recalculateContourBounds()
-                    s.reduceImageSize(self.imagePad)
-                    s.convertImageToRSP()
-                    
-                    wepl = s.convertImageToWEPL()
-                    contours = s.getStructuresInImageCoordinates()
-                    
-                    idx=0
-                    for contourX, contourY in zip(*contours):
-                        linearContour = LinearContour(s.dicomTranslation, s.pixelSpacing)
-                        linearContour.addLines(list(zip(contourX, contourY)))
-                        pixelContourMap = linearContour.getListOfPixelsInContour(s.image)
-                        weplImageBinned = np.array(wepl[pixelContourMap], dtype='int64')
-
-                        dfSum = dfSum.append(pd.DataFrame({'WEPL':weplImageBinned, '4D phase':s.amplitude,
-                                                           'structureIdx':idx, 'rotation':rot}), ignore_index=True)
-                        idx += 1
-
-        self.progress['value'] = 0
+        dfSum, thisDate = self.engine.makeDataFrame()
+        self.reducedImageCollection = self.engine.reducedImageCollection
+        print(stageProfile.getSummary())
         return dfSum, thisDate
 
+    def makeHistograms(self):
+        histograms, thisDate = self.engine.makeHistograms()
+        self.reducedImageCollection = self.engine.reducedImageCollection
+        print(stageProfile.getSummary())
+        return histograms, thisDate
+
     def makeViolinPlotCommand(self):
+        if self.options.histogramMode.get():
+            self.makeHistogramViolinPlot()
+            return
+
         dfSum, thisDate = self.makeDataFrame()
         rotations = self.getRotationList()
         
@@ -675,6 +665,23 @@ class MainMenu(Frame):
             
         plt.show()
 
+    def makeHistogramViolinPlot(self):
+        histograms, thisDate = self.makeHistograms()
+        rotations = self.getRotationList()
+
+        for rot in rotations:
+            fig = plt.figure(figsize=(12,7))
+            phases = sorted({ phase for phase, structureIdx, rotation in histograms.counts if rotation == rot })
+            vpstats = [ histograms.getViolinStats(lambda key: key[0] == phase and key[2] == rot) for phase in phases ]
+            if phases:
+                plt.gca().violin(vpstats, showmedians=True)
+                plt.xticks(range(1, len(phases)+1), phases)
+            plt.xlabel("4D phase")
+            plt.ylabel("WEPL")
+            plt.title(f"Rotation {rot} degrees; images from {thisDate}")
+
+        plt.show()
+
     def plotAllImageSeriesCommand(self):
         self.makeReducedImageCollection()
         self.loadCheckedStructures()
@@ -687,7 +694,12 @@ class MainMenu(Frame):
         plt.show()
 
     def makeVariationPlotCommand(self):
-        dfSum, thisDate = self.makeDataFrame()
+        if self.options.histogramMode.get():
+            histograms, thisDate = self.makeHistograms()
+            quartiles = histograms.getQuantileTable()
+        else:
+            dfSum, thisDate = self.makeDataFrame()
+            quartiles = dfSum.groupby(['4D phase', 'rotation'], observed=True)['WEPL'].quantile([0.25, 0.5, 0.75]).unstack()
         rotations = self.getRotationList()
 
         fig = plt.figure(figsize=(12,7))
@@ -703,10 +715,13 @@ class MainMenu(Frame):
             else:
                 thisLabel = f"{rot}° beam"
                 
-            quantiles = dfSum[dfSum['rotation'] == rot].groupby('4D phase')['WEPL'].quantile([0.25, 0.5, 0.75]).reset_index()
-            phases = [k[:-4] for k in quantiles['4D phase'].unique()]        
-            plt.plot(phases, quantiles[quantiles['level_1'] == 0.5]['WEPL'].values, color=lineColors[idx+1], label=thisLabel)
-            plt.fill_between(phases, quantiles[quantiles['level_1'] == 0.25]['WEPL'].values, quantiles[quantiles['level_1'] == 0.75]['WEPL'].values,
+            if not rot in quartiles.index.get_level_values('rotation'):
+                continue
+
+            quantiles = quartiles.xs(rot, level='rotation')
+            phases = [k[:-4] for k in quantiles.index]        
+            plt.plot(phases, quantiles[0.5].values, color=lineColors[idx+1], label=thisLabel)
+            plt.fill_between(phases, quantiles[0.25].values, quantiles[0.75].values,
                             color=fillColors[idx+1], alpha=0.5)
             plt.title("WEPL variation during free breath")
             plt.xlabel("4D phase")
@@ -892,6 +907,7 @@ print(s.getvalue())
 plt.show()
 """
 
-root = Tk()
-mainmenu = MainMenu(root)
-root.mainloop()
+if __name__ == "__main__": # The worker processes import this module
+    root = Tk()
+    mainmenu = MainMenu(root)
+    root.mainloop()
@@ -0,0 +1,126 @@
+import json, sys, time, threading
+
+try:
+    import resource
+except ImportError: # Windows
+    resource = None
+
+class StageMeasurement:
+    """Context manager adding the wall-clock time of a block to a stage of a StageProfile."""
+
+    __slots__ = ('profile', 'stage', 'start')
+
+    def __init__(self, profile, stage):
+        self.profile = profile
+        self.stage = stage
+
+    def __enter__(self):
+        self.start = time.perf_counter()
+        return self
+
+    def __exit__(self, *exc):
+        self.profile.add(self.stage, time.perf_counter() - self.start)
+        return False
+
+class StageProfile:
+    """Wall-clock time and number of calls per stage of the calculation, counters, and the peak memory.
+
+        The stages are timed with "with stageProfile.measure(stage):", which costs about a microsecond,
+        so it is always on. Each worker process has its own profile; its times are sent back with
+        the results (pop) and merged into the profile of the main process. The updates are locked, as
+        stages are also measured in other threads (e.g. the slice prefetch of the viewer)."""
+
+    def __init__(self):
+        self.lock = threading.Lock()
+        self.reset()
+
+    def reset(self):
+        self.seconds = dict() # { stage : seconds }
+        self.calls = dict() # { stage : number of calls }
+        self.counters = dict() # { name : count }
+        self.mergedWorkers = False
+        self.startTime = time.perf_counter()
+
+    def measure(self, stage):
+        return StageMeasurement(self, stage)
+
+    def add(self, stage, seconds, calls=1):
+        with self.lock:
+            self.seconds[stage] = self.seconds.get(stage, 0) + seconds
+            self.calls[stage] = self.calls.get(stage, 0) + calls
+
+    def count(self, name, n=1):
+        with self.lock:
+            self.counters[name] = self.counters.get(name, 0) + n
+
+    def pop(self):
+        """Returns the stage times and counters since the last pop, e.g. of a worker process, and clears them."""
+
+        with self.lock:
+            state = { 'stages' : { stage : (self.seconds[stage], self.calls[stage]) for stage in self.seconds },
+                      'counters' : self.counters }
+            self.seconds = dict()
+            self.calls = dict()
+            self.counters = dict()
+        return state
+
+    def merge(self, state):
+        """Add the stage times and counters of pop, e.g. from a worker process."""
+
+        with self.lock:
+            self.mergedWorkers = True
+            for stage, (seconds, calls) in state['stages'].items():
+                self.seconds[stage] = self.seconds.get(stage, 0) + seconds
+                self.calls[stage] = self.calls.get(stage, 0) + calls
+            for name, n in state['counters'].items():
+                self.counters[name] = self.counters.get(name, 0) + n
+
+    def getPeakMemory(self):
+        """Peak resident memory (bytes) of this process and of its finished worker processes, since they started.
+
+            None where not available (Windows)."""
+
+        if resource is None:
+            return None, None
+
+        unit = sys.platform == "darwin" and 1 or 1024 # ru_maxrss is in bytes on macOS, kB on Linux
+        return (resource.getrusage(resource.RUSAGE_SELF).ru_maxrss * unit,
+                resource.getrusage(resource.RUSAGE_CHILDREN).ru_maxrss * unit)
+
+    def toDict(self):
+        peakMemory, peakMemoryWorkers = self.getPeakMemory()
+        if not self.mergedWorkers:
+            peakMemoryWorkers = None
+        with self.lock:
+            stages = { stage : { 'seconds' : self.seconds[stage], 'calls' : self.calls[stage] } for stage in self.seconds }
+            counters = dict(self.counters)
+        return { 'wallTime' : time.perf_counter() - self.startTime, 'stages' : stages, 'counters' : counters,
+                 'peakMemory' : peakMemory, 'peakMemoryWorkers' : peakMemoryWorkers }
+
+    def getSummary(self):
+        """The stages (slowest first) and counters as a text table."""
+
+        profile = self.toDict()
+        stages = profile['stages']
+        totalSeconds = sum(k['seconds'] for k in stages.values()) or 1
+
+        lines = [ f"{'Stage':24s} {'calls':>9s} {'seconds':>10s} {'ms/call':>9s} {'share':>7s}" ]
+        for stage in sorted(stages, key=lambda stage: stages[stage]['seconds'], reverse=True):
+            seconds, calls = stages[stage]['seconds'], stages[stage]['calls']
+            lines.append(f"{stage:24s} {calls:9d} {seconds:10.3f} {1000 * seconds / calls:9.3f} {100 * seconds / totalSeconds:6.1f}%")
+
+        lines.append(f"{'Wall time':24s} {'':9s} {profile['wallTime']:10.3f}")
+        for name, n in profile['counters'].items():
+            lines.append(f"{name:24s} {n:9d}")
+        for name, peak in [("Peak memory", profile['peakMemory']), ("Peak memory (workers)", profile['peakMemoryWorkers'])]:
+            if peak:
+                lines.append(f"{name:24s} {peak / 2**20:9.0f} MB")
+
+        return "\n".join(lines)
+
+    def writeJSON(self, fileName):
+        with open(fileName, "w") as profileFile:
+            json.dump(self.toDict(), profileFile, indent=1)
+        return fileName
+
+stageProfile = StageProfile()
@@ -0,0 +1,114 @@
+import numpy as np
+
+from classes import rasterizePolygon, convertHUToRSP
+from cache import maskCache
+from profiling import stageProfile
+
+HU_OUTSIDE_IMAGE = -1000 # As the cval of Series.rotateImage
+
+def getFirstCrossing(start, direction):
+    """Parameter of the first pixel plane crossed from start (pixel coordinates) along direction, and between planes."""
+
+    if direction == 0:
+        return np.full(np.shape(start), np.inf), np.inf
+    if direction > 0:
+        plane = np.floor(start + 0.5) + 0.5
+    else:
+        plane = np.ceil(start - 0.5) - 0.5
+    return (plane - start) / direction, 1 / abs(direction)
+
+def traceWEPL(imageRSP, rows, cols, angle, pixelSpacing, calibration=None):
+    """Siddon ray tracing of the WEPL to the pixels (rows, cols) of an unrotated RSP image.
+
+        The beam has the same geometry as with Series.rotateImage + convertImageToWEPL: it enters at
+        the top edge of the image rotated by angle about the image centre, and the WEPL is integrated
+        up to the distal edge of the pixel. The exact intersection lengths of each ray with the pixel
+        grid are used, so no interpolation of the image is needed. Path lengths outside the image
+        (but inside the rotated frame) count as HU_OUTSIDE_IMAGE.
+
+        The rays are walked back from the distal edge of their pixel to the entrance edge, stepping
+        through the row and column planes in the order they are crossed (Amanatides and Woo), all
+        rays at once; the path left when a ray leaves the image is added in one step. The work per pixel
+        grows with its depth in the image, and the memory with the number of pixels.
+
+        Returns the WEPL [mm] of each pixel."""
+
+    nRows, nCols = np.shape(imageRSP)
+    rspOutside = convertHUToRSP(HU_OUTSIDE_IMAGE, calibration)
+
+    theta = np.deg2rad(angle)
+    dRow, dCol = np.cos(theta), -np.sin(theta) # Beam direction in (row, column) of the unrotated image
+    cRow, cCol = (nRows - 1) / 2, (nCols - 1) / 2
+
+    rows = np.asarray(rows, dtype=np.intp)
+    cols = np.asarray(cols, dtype=np.intp)
+    wepl = np.zeros(len(rows))
+
+    # Walk along -(dRow, dCol) from the distal edge of the pixel (s = 0) to the entrance edge (s = sEnd),
+    # where sEnd is the row of the pixel in the rotated image (its distance from the entrance edge) + 1.
+    # The walk starts in the pixel itself, and steps to the next row or column at each crossing.
+    sEnd = dRow * (rows - cRow) + dCol * (cols - cCol) + cRow + 1
+    sRow, dsRow = getFirstCrossing(rows + 0.5 * dRow, -dRow)
+    sCol, dsCol = getFirstCrossing(cols + 0.5 * dCol, -dCol)
+
+    # The image with a border of NaN, to find where a ray leaves it; it does not come back in
+    padded = np.full((nRows + 2, nCols + 2), np.nan)
+    padded[1:-1, 1:-1] = imageRSP
+    padded = padded.ravel()
+    rowStep = -int(np.sign(dRow)) * (nCols + 2)
+    colStep = -int(np.sign(dCol))
+
+    index = np.flatnonzero(sEnd > 0) # Pixels outside the rotated frame have no path
+    cell = (rows[index] + 1) * (nCols + 2) + cols[index] + 1
+    sEnd, sRow, sCol = sEnd[index], sRow[index], sCol[index]
+    s = np.zeros(len(index))
+    path = np.zeros(len(index))
+
+    while len(index):
+        rsp = padded[cell]
+        outside = np.isnan(rsp)
+        sNext = np.minimum(np.minimum(sRow, sCol), sEnd)
+        path += np.where(outside, rspOutside * (sEnd - s), rsp * (sNext - s))
+
+        crossRow = sRow == sNext
+        crossCol = sCol == sNext
+        sRow[crossRow] += dsRow
+        sCol[crossCol] += dsCol
+        cell += crossRow * rowStep + crossCol * colStep
+        s = sNext
+
+        finished = outside | (sNext >= sEnd)
+        if finished.any():
+            wepl[index[finished]] = path[finished]
+            active = ~finished
+            index, cell, sEnd, sRow, sCol, s, path = (array[active] for array in (index, cell, sEnd, sRow, sCol, s, path))
+
+    return wepl * pixelSpacing
+
+def calculateSliceWEPLByRayTracing(s, rot):
+    """Find the WEPL of the pixels inside each contour of the loaded (unrotated) image of s by ray tracing.
+
+        Returns a list with one array of (integer) WEPL values per contour, as calculateSliceWEPL."""
+
+    s.resetImage()
+    imageRSP = s.convertImageToRSP()
+    with stageProfile.measure("contour transform"):
+        X, Y, keys = s.getStructuresInImageCoordinates(returnKeys=True)
+
+    indicesList = list()
+    for contourX, contourY, key in zip(X, Y, keys):
+        # The unrotated mask is the same for all the rotations
+        with stageProfile.measure("rasterize"):
+            indicesList.append(maskCache.getIndices(key, lambda: rasterizePolygon(contourX, contourY, np.shape(s.image))))
+
+    if not indicesList:
+        return list()
+
+    # Each pixel is traced once, also where the contours overlap (e.g. GTV inside PTV)
+    indices, inverse = np.unique(np.concatenate(indicesList), return_inverse=True)
+    rows, cols = np.unravel_index(indices, np.shape(s.image))
+    with stageProfile.measure("ray trace"):
+        wepl = np.array(traceWEPL(imageRSP, rows, cols, rot, s.pixelSpacing, calibration=s.calibration), dtype='int64')
+
+    ends = np.cumsum([ len(contourIndices) for contourIndices in indicesList ])
+    return np.split(wepl[inverse.ravel()], ends[:-1])
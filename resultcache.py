@@ -0,0 +1,38 @@
+import numpy as np
+import os, json, hashlib
+
+RESULT_CACHE_VERSION = 1
+
+class ResultCache:
+    """Content addressed on-disk cache of the WEPL values of one contour in one image at one rotation.
+
+        The key is a hash of what the values depend on: the SOPInstanceUID of the image, the hash of
+        the contour points, the rotation and the run parameters (registration vector, HU - RSP
+        calibration and method). A later run reuses every result with the same key, e.g. after
+        adding a rotation or a structure only the new combinations are calculated."""
+
+    def __init__(self, folder):
+        self.folder = folder
+        self.hits = self.misses = 0
+
+    def getKey(self, imageUID, contourHash, rotation, parameters):
+        key = [RESULT_CACHE_VERSION, str(imageUID), contourHash, float(rotation), parameters]
+        return hashlib.sha1(json.dumps(key, sort_keys=True).encode()).hexdigest()
+
+    def getFileName(self, key):
+        return os.path.join(self.folder, key[:2], f"{key}.npy")
+
+    def contains(self, key):
+        return os.path.exists(self.getFileName(key))
+
+    def read(self, key):
+        self.hits += 1
+        return np.load(self.getFileName(key))
+
+    def write(self, key, wepl):
+        self.misses += 1
+        fileName = self.getFileName(key)
+        os.makedirs(os.path.dirname(fileName), exist_ok=True)
+        with open(fileName + ".tmp", "wb") as resultFile:
+            np.save(resultFile, np.asarray(wepl))
+        os.replace(fileName + ".tmp", fileName)
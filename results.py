@@ -0,0 +1,67 @@
+import numpy as np
+import pandas as pd
+import os
+
+try:
+    import pyarrow
+except ImportError:
+    pyarrow = None
+
+RESULT_COLUMNS = ['WEPL', '4D phase', 'structureIdx', 'rotation']
+PARTITION_COLUMNS = ['4D phase', 'rotation']
+
+class ResultTable:
+    """Collects the WEPL values per structure and work unit as typed NumPy chunks, and makes one table at the end.
+
+        Only the WEPL values are kept per pixel (as int32); the 4D phase, structure index and rotation
+        are kept once per chunk, and become categorical columns of the table."""
+
+    def __init__(self):
+        self.weplChunks = list()
+        self.chunkKeys = list() # (phase code, structure index, rotation code) per chunk
+        self.phases = dict() # { 4D phase : code }
+        self.rotations = dict() # { rotation : code }
+
+    def __len__(self):
+        return sum(len(k) for k in self.weplChunks)
+
+    def add(self, phase, structureIdx, rotation, wepl):
+        phaseCode = self.phases.setdefault(phase, len(self.phases))
+        rotationCode = self.rotations.setdefault(rotation, len(self.rotations))
+        self.weplChunks.append(np.asarray(wepl, dtype=np.int32))
+        self.chunkKeys.append((phaseCode, structureIdx, rotationCode))
+
+    def toDataFrame(self):
+        """Returns the table with the columns of RESULT_COLUMNS; the categories are sorted.
+
+            A 4D phase of None (a series without a description) is missing in the table, as pandas
+            does not allow it as a category."""
+
+        lengths = [ len(k) for k in self.weplChunks ]
+        phaseCodes, structureIdx, rotationCodes = np.array(self.chunkKeys, dtype=np.int32).reshape(-1, 3).T
+
+        return pd.DataFrame({'WEPL' : np.concatenate(self.weplChunks) if lengths else np.zeros(0, dtype=np.int32),
+                             '4D phase' : makeCategorical(np.repeat(phaseCodes, lengths), self.phases),
+                             'structureIdx' : makeCategorical(np.repeat(structureIdx, lengths), { k:k for k in set(structureIdx) }),
+                             'rotation' : makeCategorical(np.repeat(rotationCodes, lengths), self.rotations)})
+
+def makeCategorical(codes, values):
+    """Categorical of the codes of values ({ value : code }), with the values sorted and None as missing."""
+
+    categories = sorted( k for k in values if k is not None )
+    sortedCodes = { value : code for code, value in enumerate(categories) }
+    categoryCodes = np.full(max(values.values(), default=-1) + 1, -1, dtype=np.int32)
+    for value, code in values.items():
+        categoryCodes[code] = sortedCodes.get(value, -1)
+    return pd.Categorical.from_codes(categoryCodes[codes], categories=categories)
+
+def isParquetAvailable():
+    return pyarrow is not None
+
+def writeParquet(dfSum, fileName):
+    """Write the table as a Parquet dataset partitioned per 4D phase and rotation (a folder per partition)."""
+
+    if not isParquetAvailable():
+        raise ImportError("Parquet output needs pyarrow (pip install pyarrow).")
+
+    dfSum.to_parquet(fileName, partition_cols=PARTITION_COLUMNS, index=False)
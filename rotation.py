@@ -0,0 +1,58 @@
+import numpy as np
+from scipy import special
+from scipy.ndimage import spline_filter1d, map_coordinates
+
+ROTATION_ORDER = 3 # cubic splines, as scipy.ndimage.rotate
+HU_OUTSIDE_IMAGE = -1000 # cval of the rotations
+
+def makeRotationCoordinates(shape, angle, window=None):
+    """Coordinates in the input image sampled by each pixel of the image rotated by angle (degrees) about its centre.
+
+        They are computed in the same way as by scipy.ndimage.rotate (reshape=False), so that the
+        rotated images are identical, but only for the pixels in the window (slices of rows and
+        columns), if given. Returns an array of shape (2, rows, columns)."""
+
+    c, s = special.cosdg(angle), special.sindg(angle)
+    matrix = np.array([[c, s], [-s, c]])
+    center = (np.asarray(shape) - 1) / 2
+    offset = center - matrix @ center
+
+    rows = np.arange(shape[0], dtype=float)
+    columns = np.arange(shape[1], dtype=float)
+    if window is not None:
+        rows, columns = rows[window[0]], columns[window[1]]
+
+    return np.array([ (offset[k] + rows * matrix[k, 0])[:, np.newaxis] + (columns * matrix[k, 1])[np.newaxis, :]
+                      for k in range(2) ])
+
+def getSplineCoefficients(image):
+    """Cubic spline coefficients of an image (rows, columns), or of each slice of a volume (slices, rows, columns).
+
+        These are the prefiltered images interpolated by scipy.ndimage.rotate; they are made once
+        per image and then used for all the rotation angles."""
+
+    coefficients = np.array(image, dtype=np.float64)
+    for axis in (-2, -1):
+        spline_filter1d(coefficients, ROTATION_ORDER, axis, output=coefficients, mode='constant')
+    return coefficients
+
+def rotateCoefficients(coefficients, angle, out=None, window=None, dtype=None):
+    """Rotate the image(s) of these spline coefficients by angle (degrees), into out (or a new array of dtype).
+
+        Gives the same images as scipy.ndimage.rotate(image, angle, reshape=False, cval=-1000). With a
+        window (slices of rows and columns), only the pixels of the rotated image(s) inside it are
+        interpolated, and out has the shape of the window."""
+
+    shape = np.shape(coefficients)[-2:]
+    coordinates = makeRotationCoordinates(shape, angle, window)
+
+    outShape = np.shape(coordinates)[1:]
+    if out is None:
+        out = np.empty(np.shape(coefficients)[:-2] + outShape, dtype=dtype or coefficients.dtype)
+
+    planes = np.reshape(coefficients, (-1,) + shape)
+    outPlanes = out.reshape((-1,) + outShape) # a view, out is contiguous
+    for plane, outPlane in zip(planes, outPlanes):
+        map_coordinates(plane, coordinates, output=outPlane, order=ROTATION_ORDER, mode='constant',
+                        cval=HU_OUTSIDE_IMAGE, prefilter=False)
+    return out
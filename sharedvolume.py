@@ -0,0 +1,132 @@
+import numpy as np
+import queue, threading, collections
+from multiprocessing import shared_memory
+
+SLOTS_PER_CHUNK = 2 # output slots per process and chunk of work units, see OutputSlots
+
+class SharedArray:
+    """A NumPy array in a named shared memory block, for transport between processes without pickling.
+
+        The parent process creates the block (and unlinks it on close); worker processes attach to it
+        with the spec (name, shape, dtype), optionally as a read-only view."""
+
+    def __init__(self, shape, dtype, name=None):
+        self.shape = tuple(int(k) for k in shape)
+        self.dtype = np.dtype(dtype)
+
+        if name:
+            self.shm = attachSharedMemory(name)
+            self.owner = False
+        else:
+            size = max(1, int(np.prod(self.shape)) * self.dtype.itemsize)
+            self.shm = shared_memory.SharedMemory(create=True, size=size)
+            self.owner = True
+
+        self.array = np.ndarray(self.shape, dtype=self.dtype, buffer=self.shm.buf)
+
+    @classmethod
+    def attach(cls, spec, readOnly=False):
+        name, shape, dtype = spec
+        sharedArray = cls(shape, dtype, name)
+        if readOnly:
+            sharedArray.array.flags.writeable = False
+        return sharedArray
+
+    def getSpec(self):
+        return (self.shm.name, self.shape, self.dtype.str)
+
+    def close(self):
+        """Release the block. Views of self.array must have been deleted (or copied) before this."""
+
+        self.array = None
+        self.shm.close()
+        if self.owner:
+            self.shm.unlink()
+
+class OutputSlots:
+    """A fixed number of output slots in one shared array (slots, slotSize), reused by the work units.
+
+        feed gives each unit a free slot when it is submitted, and blocks while none is free. The
+        parent takes the slots in the order of submission (popSlot), which is the order of the results
+        of Pool.imap, and releases each once it has copied its values. The memory is then bounded by
+        the number of units in flight, and does not grow with the number of units of the run. There
+        should be more slots than units per chunk, or the chunk being filled could hold all of them."""
+
+    def __init__(self, numberOfSlots, slotSize, dtype=np.int32):
+        self.output = SharedArray((numberOfSlots, slotSize), dtype)
+        self.freeSlots = queue.Queue()
+        for slot in range(numberOfSlots):
+            self.freeSlots.put(slot)
+        self.submittedSlots = collections.deque()
+        self.stopped = threading.Event()
+
+    def feed(self, units):
+        """Yields unit + (slot,) for each unit, waiting for a free slot. Runs in the task thread of the pool."""
+
+        for unit in units:
+            while True:
+                try:
+                    slot = self.freeSlots.get(timeout=0.1)
+                    break
+                except queue.Empty:
+                    if self.stopped.is_set():
+                        return
+            self.submittedSlots.append(slot)
+            yield unit + (slot,)
+
+    def popSlot(self):
+        """The slot of the oldest submitted unit whose results have not been taken yet."""
+
+        return self.submittedSlots.popleft()
+
+    def release(self, slot):
+        self.freeSlots.put(slot)
+
+    def stop(self):
+        """Stop feeding, so that the pool can be terminated while feed waits for a slot."""
+
+        self.stopped.set()
+
+    def close(self):
+        self.stop()
+        self.output.close()
+
+def attachSharedMemory(name):
+    """Attach to an existing block, without registering it for cleanup when this process exits.
+
+        Before Python 3.13 the block is registered again, which is harmless for pool workers:
+        they share the resource tracker of the parent, which keeps a set of names."""
+
+    try:
+        return shared_memory.SharedMemory(name=name, track=False) # Python >= 3.13
+    except TypeError:
+        return shared_memory.SharedMemory(name=name)
+
+def getCapacity(contours):
+    """Upper bound of the number of pixels inside the contours, under any rotation.
+
+        A contour fits inside a square of side 2R around its centre for all rotations, where R is the
+        largest distance from the centre to a vertex (plus a pixel margin for the rasterization)."""
+
+    capacity = 0
+    for contourX, contourY in zip(*contours):
+        x = np.asarray(contourX, dtype=float)
+        y = np.asarray(contourY, dtype=float)
+        R = np.max(np.hypot(x - np.mean(x), y - np.mean(y)))
+        capacity += int((2*R + 4)**2)
+    return capacity
+
+def getVolumeDtype(ds):
+    """Smallest integer type holding all HU values (pixel value + RescaleIntercept) of a DICOM image."""
+
+    bits = int(ds.BitsStored)
+    intercept = int(ds.RescaleIntercept)
+    if ds.PixelRepresentation:
+        low, high = -2**(bits-1), 2**(bits-1) - 1
+    else:
+        low, high = 0, 2**bits - 1
+
+    int16 = np.iinfo(np.int16)
+    if int16.min <= low + intercept and high + intercept <= int16.max:
+        return np.int16
+    return np.int32
@@ -0,0 +1,6 @@
+import os, sys
+
+# The modules are in the repository root, and the phantom in benchmarks
+root = os.path.dirname(os.path.dirname(os.path.abspath(__file__)))
+sys.path.insert(0, root)
+sys.path.insert(0, os.path.join(root, "benchmarks"))
@@ -0,0 +1,55 @@
+import pandas as pd
+import pytest
+
+from engine import WEPLEngine, BatchOptions, Variable
+from cache import maskCache, sliceCache
+from phantom import makePhantom
+
+ROTATIONS = [0, 30, 90, 200]
+
+# Options of each mode, which must all give the WEPL of the serial calculation
+MODES = { "volume" : { 'volumeMode' : 1 },
+          "processes" : { 'numberOfProcesses' : 2 },
+          "processes, no shared memory" : { 'numberOfProcesses' : 2, 'sharedMemory' : 0 } }
+
+@pytest.fixture(scope="module")
+def phantom(tmp_path_factory):
+    folder = tmp_path_factory.mktemp("phantom")
+    structureFile = makePhantom(str(folder), matrixSize=48, numberOfSlices=6, numberOfPhases=2)
+    return str(folder / "data"), structureFile
+
+def calculateWEPL(phantom, settings):
+    dataFolder, structureFile = phantom
+    for cache in (maskCache, sliceCache):
+        cache.clear()
+
+    options = BatchOptions()
+    options.registrationVector.set("0 0 0")
+    options.rotationEntry.set("list")
+    options.rotationList.set(" ".join(str(k) for k in ROTATIONS))
+    options.structureNumberVar.set(1)
+    for name, value in settings.items():
+        options.vars[name].set(value)
+
+    engine = WEPLEngine(options)
+    engine.loadStructureFile(structureFile)
+    engine.loadFolder(dataFolder)
+    for structureName in engine.structureNames:
+        options.structureVariable[structureName] = Variable(1)
+    for name in engine.getSeriesNames():
+        options.seriesVariable[name] = Variable(1)
+
+    dfSum, thisDate = engine.makeDataFrame()
+    return dfSum
+
+@pytest.fixture(scope="module")
+def serialWEPL(phantom):
+    dfSum = calculateWEPL(phantom, {})
+    assert len(dfSum)
+    assert set(dfSum['rotation']) == set(ROTATIONS)
+    assert dfSum['4D phase'].nunique() == 2
+    return dfSum
+
+@pytest.mark.parametrize("mode", MODES)
+def test_modes_match_serial(phantom, serialWEPL, mode):
+    pd.testing.assert_frame_equal(calculateWEPL(phantom, MODES[mode]), serialWEPL)
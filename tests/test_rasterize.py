@@ -0,0 +1,47 @@
+import numpy as np
+import pytest
+from matplotlib.path import Path
+
+from classes import rasterizePolygon
+
+SHAPE = (64, 80)
+
+def getReferenceMask(x, y, shape):
+    """Pixel centres inside the polygon, from matplotlib."""
+
+    rows, cols = np.mgrid[:shape[0], :shape[1]]
+    points = np.column_stack([cols.ravel(), rows.ravel()])
+    return Path(np.column_stack([x, y])).contains_points(points).reshape(shape)
+
+def makeStar(center, outerRadius, innerRadius, numberOfPoints, phase=0.1):
+    angles = phase + np.pi * np.arange(2 * numberOfPoints) / numberOfPoints
+    radii = np.where(np.arange(2 * numberOfPoints) % 2, innerRadius, outerRadius)
+    return center[0] + radii * np.cos(angles), center[1] + radii * np.sin(angles)
+
+# The vertices are off the pixel grid, so that no pixel centre is on an edge
+POLYGONS = {
+    "triangle" : ([10.3, 50.7, 30.2], [5.1, 12.4, 40.6]),
+    "square" : ([20.25, 45.25, 45.25, 20.25], [10.25, 10.25, 35.25, 35.25]),
+    "circle" : tuple(c + 20.3 * f(np.linspace(0, 2 * np.pi, 200, endpoint=False)) for c, f in [(40.1, np.cos), (31.7, np.sin)]),
+    "star" : makeStar((40.1, 31.7), 28.3, 9.6, 7),
+    "star, many points" : makeStar((39.6, 30.2), 25.1, 12.3, 500),
+    "clipped" : ([-10.5, 90.5, 90.5, -10.5], [-5.5, -5.5, 20.5, 70.5]),
+}
+
+@pytest.mark.parametrize("name", POLYGONS)
+def test_rasterizePolygon_matches_matplotlib(name):
+    x, y = POLYGONS[name]
+    mask = rasterizePolygon(x, y, SHAPE)
+    assert mask.shape == SHAPE
+    assert mask.any()
+    np.testing.assert_array_equal(mask, getReferenceMask(x, y, SHAPE))
+
+def test_rasterizePolygon_ignores_orientation_and_start():
+    x, y = POLYGONS["star"]
+    mask = rasterizePolygon(x, y, SHAPE)
+    np.testing.assert_array_equal(rasterizePolygon(x[::-1], y[::-1], SHAPE), mask)
+    np.testing.assert_array_equal(rasterizePolygon(np.roll(x, 5), np.roll(y, 5), SHAPE), mask)
+
+def test_rasterizePolygon_degenerate():
+    assert not rasterizePolygon([1.5, 10.5], [1.5, 10.5], SHAPE).any()
+    assert not rasterizePolygon([100.5, 120.5, 110.5], [1.5, 1.5, 10.5], SHAPE).any()
@@ -0,0 +1,37 @@
+import numpy as np
+import pytest
+from scipy.ndimage import rotate
+
+from rotation import getSplineCoefficients, rotateCoefficients
+
+ANGLES = [0, 13.7, 45, 90, 180, 271.3]
+
+@pytest.fixture(scope="module")
+def image():
+    rng = np.random.default_rng(0)
+    return rng.integers(-1000, 3000, size=(48, 56)).astype(np.int16)
+
+@pytest.mark.parametrize("angle", ANGLES)
+def test_rotateCoefficients_matches_scipy(image, angle):
+    expected = rotate(image.astype(float), angle, reshape=False, cval=-1000)
+    np.testing.assert_array_equal(rotateCoefficients(getSplineCoefficients(image), angle), expected)
+
+@pytest.mark.parametrize("angle", ANGLES)
+def test_rotateCoefficients_int16(image, angle):
+    expected = rotate(image, angle, reshape=False, cval=-1000)
+    rotated = rotateCoefficients(getSplineCoefficients(image), angle, dtype=np.int16)
+    assert rotated.dtype == np.int16
+    np.testing.assert_array_equal(rotated, expected)
+
+@pytest.mark.parametrize("angle", ANGLES)
+def test_rotateCoefficients_window(image, angle):
+    window = (slice(5, 30), slice(12, 50))
+    expected = rotate(image.astype(float), angle, reshape=False, cval=-1000)[window]
+    np.testing.assert_array_equal(rotateCoefficients(getSplineCoefficients(image), angle, window=window), expected)
+
+def test_rotateCoefficients_volume_into_out(image):
+    volume = np.stack([image, image[::-1], -image])
+    out = np.empty(np.shape(volume))
+    rotated = rotateCoefficients(getSplineCoefficients(volume), 30, out=out)
+    assert rotated is out
+    np.testing.assert_array_equal(out, rotate(volume.astype(float), 30, axes=(1, 2), reshape=False, cval=-1000))
@@ -0,0 +1,31 @@
+import numpy as np
+
+from classes import integrateWEPL
+
+def integrateWEPLByLoop(imageRSP, pixelSpacing):
+    """The row by row summation of the original Series.convertImageToWEPL."""
+
+    imageWEPL = np.zeros(np.shape(imageRSP))
+    for y in range(np.shape(imageRSP)[0]):
+        imageWEPL[y,:] = imageRSP[y,:] * pixelSpacing
+        if y > 0: imageWEPL[y,:] += imageWEPL[y-1,:]
+    return imageWEPL
+
+def test_integrateWEPL_matches_loop():
+    imageRSP = np.random.default_rng(1).uniform(0, 2, size=(40, 30))
+    np.testing.assert_allclose(integrateWEPL(imageRSP, 0.98), integrateWEPLByLoop(imageRSP, 0.98), rtol=1e-12)
+
+def test_integrateWEPL_batch():
+    imagesRSP = np.random.default_rng(2).uniform(0, 2, size=(3, 40, 30))
+    pixelSpacing = [0.98, 1.17, 0.5]
+    out = np.empty(np.shape(imagesRSP))
+    assert integrateWEPL(imagesRSP, pixelSpacing, out=out) is out
+
+    for imageRSP, spacing, imageWEPL in zip(imagesRSP, pixelSpacing, out):
+        np.testing.assert_allclose(imageWEPL, integrateWEPLByLoop(imageRSP, spacing), rtol=1e-12)
+
+def test_integrateWEPL_float32():
+    imageRSP = np.random.default_rng(3).uniform(0, 2, size=(40, 30)).astype(np.float32)
+    imageWEPL = integrateWEPL(imageRSP, 0.98)
+    assert imageWEPL.dtype == np.float32
+    np.testing.assert_allclose(imageWEPL, integrateWEPLByLoop(imageRSP, 0.98), rtol=1e-5)
@@ -0,0 +1,102 @@
+import numpy as np
+import pydicom, os, json, hashlib, warnings
+
+from sharedvolume import getVolumeDtype
+
+VOLUME_CACHE_VERSION = 1
+
+def getSourceSignature(files):
+    """Hash of the names, sizes and modification times of the source files."""
+
+    sources = list()
+    for fileName in files:
+        stat = os.stat(fileName)
+        sources.append([os.path.abspath(fileName), stat.st_size, stat.st_mtime_ns])
+    return hashlib.sha1(json.dumps(sources).encode()).hexdigest()
+
+def getVolumeCacheFileNames(cacheFolder, seriesPath):
+    name = hashlib.sha1(os.path.abspath(seriesPath).encode()).hexdigest()
+    return os.path.join(cacheFolder, f"volume_{name}.npy"), os.path.join(cacheFolder, f"volume_{name}.json")
+
+def removeFile(fileName):
+    if os.path.exists(fileName):
+        os.remove(fileName)
+
+def openVolumeCache(cacheFolder, seriesPath, files):
+    """Returns the name of an up-to-date .npy HU volume of the files (in the given order), writing it if needed.
+
+        The volume is valid as long as the names, sizes and modification times of the files are the
+        same as when it was written. Returns None if the images cannot be stacked into one volume; this
+        is recorded in the sidecar, so that the files are not decoded again until they change."""
+
+    volumeFile, sidecarFile = getVolumeCacheFileNames(cacheFolder, seriesPath)
+    signature = getSourceSignature(files)
+
+    try:
+        with open(sidecarFile, "r") as sidecar:
+            geometry = json.load(sidecar)
+        if geometry.get("version") == VOLUME_CACHE_VERSION and geometry.get("signature") == signature:
+            if not geometry.get("stackable", True):
+                return None
+            if os.path.exists(volumeFile):
+                return volumeFile
+    except (OSError, ValueError):
+        pass
+
+    return writeVolumeCache(volumeFile, sidecarFile, files, signature)
+
+def writeVolumeCache(volumeFile, sidecarFile, files, signature):
+    """Decode the files into a (slices, rows, columns) HU volume file, with a JSON sidecar of the geometry."""
+
+    if not files:
+        return None
+
+    os.makedirs(os.path.dirname(volumeFile), exist_ok=True)
+    geometry = { "version" : VOLUME_CACHE_VERSION, "signature" : signature, "files" : list(files),
+                 "ImagePositionPatient" : list(), "ImageOrientationPatient" : list(),
+                 "PixelSpacing" : list(), "SOPInstanceUID" : list() }
+
+    volume = None
+    try:
+        for idx, fileName in enumerate(files):
+            ds = pydicom.dcmread(fileName)
+            image = np.array(ds.pixel_array, dtype='int') + int(ds.RescaleIntercept)
+
+            if volume is None:
+                volume = np.lib.format.open_memmap(volumeFile + ".tmp", mode="w+", dtype=getVolumeDtype(ds),
+                                                   shape=(len(files),) + np.shape(image))
+            elif np.shape(image) != volume.shape[1:] or np.dtype(getVolumeDtype(ds)).itemsize > volume.dtype.itemsize:
+                warnings.warn(f"The images of {os.path.dirname(fileName)} cannot be stacked, not caching the volume.",
+                              RuntimeWarning)
+                del volume
+                os.remove(volumeFile + ".tmp")
+                removeFile(volumeFile)
+                writeSidecar(sidecarFile, { "version" : VOLUME_CACHE_VERSION, "signature" : signature, "stackable" : False })
+                return None
+
+            volume[idx] = image
+            geometry["ImagePositionPatient"].append([float(k) for k in ds.ImagePositionPatient])
+            geometry["ImageOrientationPatient"].append([float(k) for k in ds.get("ImageOrientationPatient", [])])
+            geometry["PixelSpacing"].append([float(k) for k in ds.PixelSpacing])
+            geometry["SOPInstanceUID"].append(str(ds.SOPInstanceUID))
+
+        volume.flush()
+        del volume
+        os.replace(volumeFile + ".tmp", volumeFile)
+
+    except BaseException:
+        volume = None # close the memory map before removing its file
+        removeFile(volumeFile + ".tmp")
+        raise
+
+    writeSidecar(sidecarFile, geometry)
+    return volumeFile
+
+def writeSidecar(sidecarFile, geometry):
+    try:
+        with open(sidecarFile + ".tmp", "w") as sidecar:
+            json.dump(geometry, sidecar)
+        os.replace(sidecarFile + ".tmp", sidecarFile)
+    except BaseException:
+        removeFile(sidecarFile + ".tmp")
+        raise